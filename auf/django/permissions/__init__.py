@@ -1,19 +1,52 @@
 # encoding: utf-8
 
+import hashlib
 import itertools
+import logging
 import re
+import threading
+import time
 import urlparse
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.contrib.auth.views import redirect_to_login
-from django.core.exceptions import ImproperlyConfigured, PermissionDenied
-from django.db.models import Q, Manager
+from django.core.exceptions import FieldError, ImproperlyConfigured, \
+        PermissionDenied
+from django.db import close_old_connections, transaction
+from django.db.models import BooleanField, Manager, Model, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.query import QuerySet, prefetch_related_objects
 from django.http import HttpResponseForbidden
 from django.template.loader import render_to_string
 try:
     from importlib import import_module
 except ImportError:  # python 2.6
     from django.utils.importlib import import_module
+try:
+    from django.db.models import Case, Value, When
+except ImportError:  # django < 1.8
+    Case = Value = When = None
+try:
+    from django.core.cache import caches
+except ImportError:  # django < 1.7
+    from django.core.cache import get_cache
+else:
+    get_cache = caches.__getitem__
+
+try:
+    from django.contrib.auth import get_user_model as _get_user_model
+except ImportError:  # django < 1.5
+    from django.contrib.auth.models import User
+    _get_user_model = lambda: User
+try:
+    _atomic = transaction.atomic
+except AttributeError:  # django < 1.6
+    _atomic = transaction.commit_on_success
+
+logger = logging.getLogger('auf.django.permissions')
 
 
 # Roles and role providers
@@ -25,6 +58,12 @@ class Role(object):
     Doesn't give any permission.
     """
 
+    # Permissions and models this role can give permissions for. A role is
+    # never consulted about other permissions or about instances of other
+    # models. None means any permission or any model.
+    handled_perms = None
+    handled_models = None
+
     def has_perm(self, perm, obj=None):
         """
         Checks if this role gives the permission ``perm``.
@@ -49,6 +88,71 @@ class Role(object):
         """
         return False
 
+    def get_perms(self):
+        """
+        Returns the set of global permissions given by this role, or None if
+        the role can't list them.
+
+        When a role lists its global permissions, they are checked with set
+        lookups instead of calls to ``has_perm()``.
+        """
+        return None
+
+    def get_cache_key(self):
+        """
+        Returns a hashable key identifying the filters given by this role, or
+        None if the filters must not be cached.
+
+        Roles of the same class that return the same key must return the
+        same filters from ``get_filter_for_perm()``. The key is typically
+        built from the arguments given to the constructor.
+        """
+        return None
+
+
+def get_role_filter(role, perm, model):
+    """
+    Returns ``role.get_filter_for_perm(perm, model)``.
+
+    If the role provides a cache key, the filter is computed only once for
+    all the roles of the same class that have the same key.
+    """
+    get_cache_key = getattr(role, 'get_cache_key', None)
+    key = get_cache_key() if get_cache_key is not None else None
+    if key is None:
+        return _role_get_filter(role, perm, model)
+
+    key = (type(role), key)
+    try:
+        filters = _filter_cache[key]
+    except KeyError:
+        if len(_filter_cache) >= FILTER_CACHE_SIZE:
+            _filter_cache.clear()
+        filters = _filter_cache[key] = {}
+    try:
+        return filters[(perm, model)]
+    except KeyError:
+        q = filters[(perm, model)] = _role_get_filter(role, perm, model)
+        return q
+_filter_cache = {}
+FILTER_CACHE_SIZE = 10000
+
+
+def _role_get_filter(role, perm, model):
+    if not _collectors:
+        return role.get_filter_for_perm(perm, model)
+    start = time.time()
+    q = role.get_filter_for_perm(perm, model)
+    _record('get_filter_for_perm', _get_name(type(role)), start)
+    return q
+
+
+def clear_filter_cache():
+    """
+    Forgets all the filters cached by :func:`get_role_filter`.
+    """
+    _filter_cache.clear()
+
 
 def get_role_providers():
     """
@@ -80,10 +184,406 @@ _role_providers = None
 def get_roles(user):
     """
     Returns the roles given to a user.
+
+    The role providers are called only once per user object: the roles are
+    then cached on the user until :func:`invalidate_roles` is called.
+
+    If the ``ROLE_CACHE`` setting names a Django cache, the roles are also
+    shared across requests through that cache until
+    :func:`bump_roles_version` is called for the user.
+    """
+    try:
+        return user._role_cache
+    except AttributeError:
+        pass
+
+    cache = _get_role_cache()
+    if cache is None or user.pk is None:
+        stream = getattr(user, '_role_stream', None)
+        if stream is None:
+            roles = _call_role_providers(user)[0]
+        else:
+            # Some providers were already called by iter_roles().
+            roles = stream.finish()
+    else:
+        key = _get_roles_key(cache, user)
+        roles = cache.get(key)
+        if roles is None:
+            roles, complete = _call_role_providers(user)
+            # Don't share the roles if some providers timed out.
+            if complete:
+                timeout = getattr(settings, 'ROLE_CACHE_TIMEOUT', None)
+                if timeout is None:
+                    cache.set(key, roles)
+                else:
+                    cache.set(key, roles, timeout)
+    user._role_cache = roles
+    return roles
+
+
+def _call_role_providers(user):
+    """
+    Calls the role providers and returns the roles they give, in the order
+    of the providers, along with a flag telling whether all the providers
+    answered in time.
+
+    If the ``ROLE_PROVIDERS_THREADS`` setting is set, the providers are run
+    concurrently on a pool of that many threads. Providers that don't answer
+    within ``ROLE_PROVIDERS_TIMEOUT`` seconds don't give any role.
+    """
+    providers = get_role_providers()
+    threads = getattr(settings, 'ROLE_PROVIDERS_THREADS', None)
+    if not threads or len(providers) < 2:
+        roles = list(itertools.chain.from_iterable(
+            _call_provider(p, user) for p in providers
+        ))
+        return roles, True
+
+    pool = _get_provider_pool(threads)
+    timeout = getattr(settings, 'ROLE_PROVIDERS_TIMEOUT', None)
+    results = [pool.apply_async(_run_provider, (p, user)) for p in providers]
+    if timeout is not None:
+        deadline = time.time() + timeout
+    roles = []
+    complete = True
+    for provider, result in zip(providers, results):
+        try:
+            if timeout is None:
+                roles.extend(result.get())
+            else:
+                roles.extend(result.get(max(deadline - time.time(), 0)))
+        except TimeoutError:
+            logger.warning(
+                'Role provider %s timed out for user %s',
+                _get_name(provider), user.pk
+            )
+            complete = False
+    return roles, complete
+
+
+def get_roles_many(users):
+    """
+    Returns the roles given to each of ``users``, as a list of lists in the
+    order of ``users``.
+
+    The roles of the users are cached on them like with :func:`get_roles`.
+    A role provider that has a ``many`` attribute is called once for all
+    the users whose roles are not cached yet: ``provider.many(users)`` must
+    return the list of the roles of each user. The other providers are
+    called once per user.
+    """
+    users = list(users)
+    pending = [user for user in users if not hasattr(user, '_role_cache')]
+    if pending:
+        results = [[] for user in pending]
+        for provider in get_role_providers():
+            many = getattr(provider, 'many', None)
+            if many is not None:
+                roles = many(pending)
+            else:
+                roles = [_call_provider(provider, user) for user in pending]
+            for result, user_roles in zip(results, roles):
+                result.extend(user_roles)
+        for user, roles in zip(pending, results):
+            user._role_cache = roles
+    return [user._role_cache for user in users]
+
+
+def iter_roles(user):
+    """
+    Iterates over the roles given to a user, calling the role providers
+    only as the iteration needs them.
+
+    The roles are pulled lazily only when they are not cached yet and when
+    the providers are run sequentially without a shared cache. Otherwise,
+    this is the same as iterating over :func:`get_roles`.
+    """
+    try:
+        return iter(user._role_cache)
+    except AttributeError:
+        pass
+    if (_get_role_cache() is not None and user.pk is not None) \
+       or getattr(settings, 'ROLE_PROVIDERS_THREADS', None):
+        return iter(get_roles(user))
+    try:
+        stream = user._role_stream
+    except AttributeError:
+        stream = user._role_stream = _RoleStream(user)
+    return iter(stream)
+
+
+class _RoleStream(object):
+    """
+    The roles of a user, pulled from the role providers as they are needed.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.providers = iter(get_role_providers())
+        self.roles = []
+
+    def __iter__(self):
+        i = 0
+        while True:
+            while i < len(self.roles):
+                yield self.roles[i]
+                i += 1
+            for provider in self.providers:
+                self.roles.extend(_call_provider(provider, self.user))
+                break
+            else:
+                return
+
+    def finish(self):
+        for provider in self.providers:
+            self.roles.extend(_call_provider(provider, self.user))
+        return self.roles
+
+
+def _get_provider_pool(threads):
+    global _provider_pool
+    with _provider_pool_lock:
+        if _provider_pool is None:
+            _provider_pool = ThreadPool(threads)
+    return _provider_pool
+_provider_pool = None
+_provider_pool_lock = threading.Lock()
+
+
+def _call_provider(provider, user):
+    if not _collectors:
+        return provider(user)
+    start = time.time()
+    roles = list(provider(user))
+    _record('provider', _get_name(provider), start)
+    return roles
+
+
+def _run_provider(provider, user):
+    try:
+        return list(_call_provider(provider, user))
+    finally:
+        # Worker threads have their own database connections.
+        close_old_connections()
+
+
+def invalidate_roles(user):
+    """
+    Forgets the roles cached on ``user`` so that the role providers are
+    called again on the next permission check.
+    """
+    for attr in _USER_CACHE_ATTRS:
+        try:
+            delattr(user, attr)
+        except AttributeError:
+            pass
+# Attributes set on user objects to cache roles and everything derived from
+# them.
+_USER_CACHE_ATTRS = (
+    '_role_cache', '_role_stream', '_role_index', '_global_perm_cache',
+    '_obj_perm_cache',
+)
+
+
+# Shared role cache
+
+def bump_roles_version(user=None):
+    """
+    Invalidates the roles of ``user`` (a user or a user's primary key) in
+    the shared role cache. If ``user`` is None, the roles of all the users
+    are invalidated.
+    """
+    cache = _get_role_cache()
+    if cache is None:
+        return
+    key = _roles_version_key(getattr(user, 'pk', user))
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The version was evicted, any new version will do.
+        _new_roles_version(cache, key)
+
+
+def _get_role_cache():
+    alias = getattr(settings, 'ROLE_CACHE', None)
+    return None if alias is None else get_cache(alias)
+
+
+def _roles_version_key(pk):
+    if pk is None:
+        return 'auf.django.permissions.roles_version'
+    return 'auf.django.permissions.roles_version:%s' % pk
+
+
+def _new_roles_version(cache, key):
+    # Start from the current time so that entries of an evicted version are
+    # never reused. Milliseconds are too coarse: a version evicted right
+    # after it was created would come back with the same value.
+    version = int(time.time() * 1000000)
+    cache.set(key, version, None)
+    return version
+
+
+def _get_roles_key(cache, user):
+    keys = [_roles_version_key(None), _roles_version_key(user.pk)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            versions[key] = _new_roles_version(cache, key)
+    return 'auf.django.permissions.roles:%s:%s:%s' % (
+        user.pk, versions[keys[0]], versions[keys[1]]
+    )
+
+
+# Invalidation of cached roles and filters
+
+def register_role_dependency(model, get_users=None):
+    """
+    Declares that the roles given by the role providers depend on the
+    instances of ``model``.
+
+    Whenever an instance of ``model`` is saved or deleted, or one of its
+    many-to-many relations changes, the roles of the users returned by
+    ``get_users(instance)`` (users or primary keys) are invalidated in the
+    shared role cache. If ``get_users`` is None, the roles of all the users
+    are invalidated. If the instance is itself a role with a cache key, its
+    cached filters are dropped as well, but only in the current process.
+
+    Proxy models and instances with deferred fields count as instances of
+    their concrete model.
+    """
+    model = model._meta.concrete_model
+    _role_dependencies.setdefault(model, []).append(get_users)
+    # Proxy models and deferred instances are sent with their own class, so
+    # the receivers listen to all the models.
+    post_save.connect(
+        _instance_changed, dispatch_uid='auf.django.permissions.post_save'
+    )
+    post_delete.connect(
+        _instance_changed, dispatch_uid='auf.django.permissions.post_delete'
+    )
+    m2m_changed.connect(
+        _m2m_changed, dispatch_uid='auf.django.permissions.m2m_changed'
+    )
+_role_dependencies = {}
+
+
+def _instance_changed(sender, instance, **kwargs):
+    model = instance._meta.concrete_model
+    dependencies = _role_dependencies.get(model)
+    for get_users in dependencies or []:
+        if get_users is None:
+            bump_roles_version()
+        else:
+            for user in get_users(instance):
+                bump_roles_version(user)
+    # Other models may have an unrelated get_cache_key() method.
+    if dependencies is None and not isinstance(instance, Role):
+        return
+    get_cache_key = getattr(instance, 'get_cache_key', None)
+    if get_cache_key is not None:
+        key = get_cache_key()
+        if key is not None:
+            _filter_cache.pop((type(instance), key), None)
+            _filter_cache.pop((model, key), None)
+
+
+def _m2m_changed(sender, instance, action, reverse, model, pk_set,
+                 **kwargs):
+    model = model._meta.concrete_model
+    if action == 'pre_clear':
+        # The cleared objects aren't known anymore after the fact.
+        if model in _role_dependencies:
+            cleared = instance.__dict__.setdefault('_role_cleared_pks', {})
+            cleared[sender] = _get_related_pks(
+                sender, instance, model, reverse
+            )
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.get('_role_cleared_pks', {}) \
+                .pop(sender, None)
+    if instance._meta.concrete_model in _role_dependencies:
+        _instance_changed(type(instance), instance)
+    if model in _role_dependencies and pk_set:
+        for obj in model._default_manager.filter(pk__in=pk_set):
+            _instance_changed(model, obj)
+
+
+def _get_related_pks(through, instance, model, reverse):
+    """
+    Returns the primary keys of the instances of ``model`` related to
+    ``instance`` by the many-to-many relation whose intermediate model is
+    ``through``.
+    """
+    for field in (model if reverse else type(instance))._meta.many_to_many:
+        rel = getattr(field, 'remote_field', None) or field.rel
+        if rel.through is not through:
+            continue
+        if reverse:
+            source, target = field.m2m_reverse_field_name(), \
+                    field.m2m_field_name()
+        else:
+            source, target = field.m2m_field_name(), \
+                    field.m2m_reverse_field_name()
+        return list(
+            through._base_manager.using(instance._state.db)
+            .filter(**{source: instance.pk})
+            .values_list(target, flat=True)
+        )
+    return []
+
+
+def get_roles_for_perm(user, perm, model=None):
+    """
+    Returns the roles given to a user that can give the permission ``perm``
+    on instances of ``model``, according to their ``handled_perms`` and
+    ``handled_models`` attributes.
+
+    If ``model`` is None, only global permissions are considered and the
+    ``handled_models`` attribute is ignored.
+    """
+    try:
+        index = user._role_index
+    except AttributeError:
+        index = user._role_index = {}
+    try:
+        return index[(perm, model)]
+    except KeyError:
+        roles = index[(perm, model)] = [
+            role for role in get_roles(user)
+            if _role_handles(type(role), perm, model)
+        ]
+        return roles
+
+
+def _role_handles(cls, perm, model):
+    try:
+        perms, models = _role_capabilities[cls]
+    except KeyError:
+        perms = getattr(cls, 'handled_perms', None)
+        models = getattr(cls, 'handled_models', None)
+        perms, models = _role_capabilities[cls] = (
+            None if perms is None else frozenset(perms),
+            None if models is None else frozenset(models),
+        )
+    return (perms is None or perm in perms) and (
+        model is None or models is None or model in models
+        or any(issubclass(model, m) for m in models)
+    )
+_role_capabilities = {}
+
+
+def _get_model(obj):
+    """
+    Returns the model of ``obj``. Instances with deferred fields belong to
+    a generated subclass of their model on Django < 1.10.
     """
-    return list(itertools.chain.from_iterable(
-        p(user) for p in get_role_providers()
-    ))
+    model = type(obj)
+    if getattr(model, '_deferred', False):
+        model = model._meta.proxy_for_model
+    return model
 
 
 # Permission checking
@@ -91,148 +591,1431 @@ def get_roles(user):
 def user_has_perm(user, perm, obj=None):
     """
     Checks whether a user has the given permission.
+
+    The role providers are consulted one at a time until a role grants the
+    permission, see :func:`iter_roles`. Once all the roles are known, global
+    permissions are looked up in :func:`get_global_perms`.
     """
-    roles = get_roles(user)
-    if any(role.has_perm(perm, obj) for role in roles):
+    model = None if obj is None else _get_model(obj)
+    if obj is None and hasattr(user, '_role_cache'):
+        perms, unlisted = get_global_perms(user)
+        if perm in perms:
+            return True
+        roles = (
+            role for role in unlisted
+            if _role_handles(type(role), perm, None)
+        )
+    else:
+        try:
+            roles = user._role_index[(perm, model)]
+        except (AttributeError, KeyError):
+            roles = (
+                role for role in iter_roles(user)
+                if _role_handles(type(role), perm, model)
+            )
+    if any(_role_has_perm(role, perm, obj) for role in roles):
         return True
     elif obj is not None:
-        for role in roles:
-            q = role.get_filter_for_perm(perm, type(obj))
-            if q is True or (isinstance(q, Q) and qeval(obj, q)):
+        for role in get_roles_for_perm(user, perm, model):
+            q = get_role_filter(role, perm, model)
+            if q is True or (isinstance(q, Q) and matches_filter(obj, q)):
                 return True
     return False
 
 
+def _role_has_perm(role, perm, obj):
+    if not _collectors:
+        return role.has_perm(perm, obj)
+    start = time.time()
+    result = role.has_perm(perm, obj)
+    _record('has_perm', _get_name(type(role)), start)
+    return result
+
+
+def get_global_perms(user):
+    """
+    Returns the frozenset of the global permissions listed by the roles of
+    ``user``, along with the list of the roles that can't list them.
+
+    The result is cached on the user until :func:`invalidate_roles` is
+    called.
+    """
+    try:
+        return user._global_perm_cache
+    except AttributeError:
+        perms = set()
+        unlisted = []
+        for role in get_roles(user):
+            get_perms = getattr(role, 'get_perms', None)
+            role_perms = get_perms() if get_perms is not None else None
+            if role_perms is None:
+                unlisted.append(role)
+            else:
+                perms.update(role_perms)
+        user._global_perm_cache = (frozenset(perms), unlisted)
+        return user._global_perm_cache
+
+
+def user_has_perm_many(user, perm, objs):
+    """
+    Checks whether a user has the given permission on each object of
+    ``objs``. All the objects must be instances of the same model.
+
+    Returns a dictionary mapping the primary key of each object to a
+    boolean. The role filters are evaluated in the database with a single
+    query per batch of ``BULK_CHECK_BATCH_SIZE`` objects.
+    """
+    objs = list(objs)
+    result = {}
+    if not objs:
+        return result
+
+    model = _get_model(objs[0])
+    roles = get_roles_for_perm(user, perm, model)
+    remaining = []
+    for obj in objs:
+        if any(_role_has_perm(role, perm, obj) for role in roles):
+            result[obj.pk] = True
+        else:
+            result[obj.pk] = False
+            remaining.append(obj.pk)
+
+    manager = model._default_manager
+    for i in range(0, len(remaining), BULK_CHECK_BATCH_SIZE):
+        batch = remaining[i:i + BULK_CHECK_BATCH_SIZE]
+        queryset = queryset_with_perm(
+            manager.filter(pk__in=batch), user, perm
+        )
+        for pk in queryset.values_list('pk', flat=True):
+            result[pk] = True
+    return result
+BULK_CHECK_BATCH_SIZE = 500
+
+
+def has_perm_many(user, perm, objs):
+    """
+    Checks ``user.has_perm(perm, obj)`` for each object of ``objs`` and
+    returns a dictionary mapping the primary key of each object to the
+    result.
+
+    The permissions are checked in bulk when the roles are the only source
+    of permissions, that is when :class:`AuthenticationBackend` is the only
+    authentication backend. Otherwise, ``user.has_perm()`` is called for
+    each object.
+
+    Like with ``user.has_perm()``, the role filters that span multi-valued
+    relations are evaluated with :func:`qeval_many` rather than in the
+    database, unless the ``PERMISSION_OBJECT_STRATEGY`` setting is
+    ``'database'``.
+    """
+    objs = list(objs)
+    if user.is_active and user.is_superuser:
+        return dict((obj.pk, True) for obj in objs)
+    elif list(getattr(settings, 'AUTHENTICATION_BACKENDS', ())) != \
+            ['auf.django.permissions.AuthenticationBackend']:
+        # Other backends may grant the permission too.
+        return dict((obj.pk, user.has_perm(perm, obj)) for obj in objs)
+    elif not objs or getattr(
+        settings, 'PERMISSION_OBJECT_STRATEGY', 'auto'
+    ) == 'database':
+        return user_has_perm_many(user, perm, objs)
+
+    model = _get_model(objs[0])
+    roles = get_roles_for_perm(user, perm, model)
+    filters = [get_role_filter(role, perm, model) for role in roles]
+    if not any(
+        isinstance(q, Q) and _spans_multivalued(model, compile_q(q).paths)
+        for q in filters
+    ):
+        return user_has_perm_many(user, perm, objs)
+
+    result = {}
+    remaining = []
+    for obj in objs:
+        if any(_role_has_perm(role, perm, obj) for role in roles):
+            result[obj.pk] = True
+        else:
+            result[obj.pk] = False
+            remaining.append(obj)
+    for q in filters:
+        if not remaining:
+            break
+        elif q is True:
+            matched = [True] * len(remaining)
+        elif isinstance(q, Q):
+            matched = qeval_many(remaining, q)
+        else:
+            continue
+        for obj, granted in zip(remaining, matched):
+            if granted:
+                result[obj.pk] = True
+        remaining = [
+            obj for obj, granted in zip(remaining, matched) if not granted
+        ]
+    return result
+
+
+def users_with_perm(obj, perm, users=None):
+    """
+    Returns the list of the users that have the permission ``perm`` on
+    ``obj``, among ``users`` (all the users by default).
+
+    Superusers are selected in the database when ``users`` is a queryset.
+    The other users are fetched in batches, their roles are gathered with
+    :func:`get_roles_many`, and the filter of each distinct role is
+    evaluated only once on the object: roles with the same class and cache
+    key give the same filters. Roles without a cache key are evaluated once
+    per batch.
+    """
+    if users is None:
+        users = _get_user_model()._default_manager.all()
+    if isinstance(users, QuerySet):
+        result = list(users.filter(is_active=True, is_superuser=True))
+        users = users.exclude(is_active=True, is_superuser=True).iterator()
+    else:
+        result = []
+    model = _get_model(obj)
+    filter_results = {}
+    for batch in _batches(users):
+        # Roles without a cache key are identified by their id(), which is
+        # only unique while they are alive: the users of the batch keep them
+        # alive until the next one.
+        batch_results = {}
+        for user, roles in zip(batch, get_roles_many(batch)):
+            if user.is_active and user.is_superuser:
+                result.append(user)
+                continue
+            roles = [r for r in roles if _role_handles(type(r), perm, model)]
+            if any(_role_has_perm(role, perm, obj) for role in roles):
+                result.append(user)
+                continue
+            for role in roles:
+                key = _get_role_identity(role)
+                results = batch_results if isinstance(key, (int, long)) \
+                        else filter_results
+                try:
+                    granted = results[key]
+                except KeyError:
+                    q = get_role_filter(role, perm, model)
+                    granted = results[key] = q is True or (
+                        isinstance(q, Q) and matches_filter(obj, q)
+                    )
+                if granted:
+                    result.append(user)
+                    break
+    return result
+
+
+def _get_role_identity(role):
+    get_cache_key = getattr(role, 'get_cache_key', None)
+    key = get_cache_key() if get_cache_key is not None else None
+    if key is None:
+        return id(role)
+    return (type(role), key)
+
+
+def _batches(iterable, size=None):
+    """
+    Splits ``iterable`` into lists of ``size`` items at most.
+    """
+    size = size or BULK_CHECK_BATCH_SIZE
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
 def queryset_with_perm(queryset, user, perm):
     """
     Filters ``queryset``, leaving only objects on which ``user`` has the
     permission ``perm``.
     """
-    # Special case: superusers have all permissions on all objects.
-    if user.is_superuser:
+    if not _collectors:
+        return _queryset_with_perm(queryset, user, perm)
+    start = time.time()
+    queryset = _queryset_with_perm(queryset, user, perm)
+    _record('queryset_with_perm', _get_model_name(queryset.model), start)
+    return queryset
+
+
+def _queryset_with_perm(queryset, user, perm):
+    # Special case: active superusers have all permissions on all objects.
+    if user.is_active and user.is_superuser:
+        return queryset
+
+    query = _get_queryset_filter(user, perm, queryset.model)
+    if query is True:
         return queryset
+    elif query:
+        return queryset.filter(query)
+    else:
+        return queryset.none()
 
-    roles = get_roles(user)
+
+def queryset_annotate_perms(queryset, user, perms):
+    """
+    Annotates each object of ``queryset`` with a boolean for each
+    permission of ``perms``, telling whether ``user`` has that permission
+    on the object. The annotation for permission ``perm`` is named
+    ``can_<perm>``.
+    """
+    if Case is None:
+        raise NotImplementedError(
+            'annotate_perms() requires conditional expressions (Django 1.8)'
+        )
+    model = queryset.model
+    annotations = {}
+    for perm in perms:
+        if user.is_active and user.is_superuser:
+            query = True
+        else:
+            # Joins on multi-valued relations would duplicate the rows.
+            query = _get_queryset_filter(user, perm, model, subqueries=True)
+        if query is True:
+            expression = Value(True, output_field=BooleanField())
+        elif query:
+            expression = Case(
+                When(query, then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField()
+            )
+        else:
+            expression = Value(False, output_field=BooleanField())
+        annotations['can_%s' % perm] = expression
+    return queryset.annotate(**annotations)
+
+
+def _get_roles_filter(roles, perm, model):
+    """
+    Combines the filters of ``roles`` for permission ``perm`` on ``model``.
+
+    Returns True if one of the roles grants the permission on all
+    instances, a Q object if some instances are selected and None if the
+    roles don't give the permission at all.
+    """
     query = None
     for role in roles:
-        q = role.get_filter_for_perm(perm, queryset.model)
+        q = get_role_filter(role, perm, model)
         if q is True:
-            return queryset
+            return True
         elif q is not False:
             if query:
                 query |= q
             else:
                 query = q
     if query:
-        return queryset.filter(query)
-    else:
-        return queryset.none()
+        query = simplify_q(query, model)
+    return query
+
+
+def _get_queryset_filter(user, perm, model, subqueries=False):
+    """
+    Returns the filter to apply to a queryset of ``model`` to keep the
+    objects on which ``user`` has the permission ``perm``: True, a Q object
+    or None, like :func:`_get_roles_filter`.
+
+    If ``subqueries`` is true, the lookups across multi-valued relations
+    are always rewritten with :func:`rewrite_subqueries`.
+    """
+    roles = get_roles_for_perm(user, perm, model)
+    if perm in get_materialized_perms(model):
+        return _get_materialized_filter(roles, perm, model, subqueries)
+    return _get_sql_filter(
+        _get_roles_filter(roles, perm, model), model, subqueries
+    )
+
+
+def _get_sql_filter(query, model, subqueries=False):
+    if isinstance(query, Q) and (subqueries or getattr(
+        settings, 'PERMISSION_FILTER_SUBQUERIES', False
+    )):
+        return rewrite_subqueries(query, model)
+    return query
 
 
 def qeval(obj, q):
     """
     Evaluates a Q object on an instance of a model.
+
+    The deferred fields of the instance that the Q object needs are loaded
+    together with a single query beforehand, instead of one query per
+    field.
     """
-    def q_getattr(x, attr):
-        y = getattr(x, attr)
-        if y is None:
-            return
-        elif isinstance(y, Manager):
-            for z in y.all():
-                yield z
-        else:
-            yield y
+    predicate = compile_q(q)
+    if not _collectors:
+        _load_deferred_fields(obj, predicate.paths)
+        return predicate(obj)
+    start = time.time()
+    queries = _get_relation_queries()
+    _load_deferred_fields(obj, predicate.paths)
+    result = predicate(obj)
+    _record(
+        'qeval', _get_model_name(type(obj)), start,
+        _get_relation_queries() - queries
+    )
+    return result
+
+
+def _load_deferred_fields(obj, paths):
+    """
+    Loads the deferred fields met when following the attribute paths
+    ``paths`` from ``obj`` and from the related objects already cached on
+    it, with a single query per object.
+    """
+    deferred = {}
+    for fields in _get_field_paths(type(obj), paths):
+        current = obj
+        for field in fields:
+            if _is_deferred(current, field):
+                attnames = deferred.setdefault(id(current), (current, []))[1]
+                if field.attname not in attnames:
+                    attnames.append(field.attname)
+                break
+            if field is fields[-1]:
+                break
+            current = getattr(current, field.get_cache_name(), None)
+            if current is None:
+                break
+
+    for current, attnames in deferred.itervalues():
+        if len(attnames) < 2:
+            # Django would load the field with one query too.
+            continue
+        start = time.time()
+        rows = list(
+            type(current)._base_manager.using(current._state.db)
+            .filter(pk=current.pk).values(*attnames)[:1]
+        )
+        if not rows:
+            # Deleted object, let Django complain.
+            continue
+        for attname in attnames:
+            setattr(current, attname, rows[0][attname])
+        if _collectors:
+            _count_relation_query()
+            # Instances with deferred fields belong to a generated subclass.
+            name = _get_model_name(current._meta.concrete_model)
+            _record('deferred_load', name, start, 1)
+            for i in range(len(attnames) - 1):
+                _record('avoided_deferred_load', name, time.time())
+
+
+def _get_field_paths(model, paths):
+    """
+    Resolves the attribute paths ``paths`` from ``model`` into tuples of
+    fields, stopping at the first attribute that isn't a model field or
+    that isn't a single-valued relation, so that only the fields that can
+    be deferred are kept.
+
+    The result is cached by model and paths.
+    """
+    key = (model, tuple(tuple(path) for path in paths))
+    try:
+        return _field_paths_cache[key]
+    except KeyError:
+        pass
+    field_paths = []
+    for path in paths:
+        fields = []
+        current = model
+        for attr in path:
+            try:
+                field = current._meta.get_field(attr)
+            except FieldDoesNotExist:
+                break
+            fields.append(field)
+            if not getattr(field, 'is_relation', False) \
+               or field.many_to_many or field.one_to_many:
+                break
+            current = field.related_model
+        if fields and tuple(fields) not in field_paths:
+            field_paths.append(tuple(fields))
+    if len(_field_paths_cache) >= COMPILED_Q_CACHE_SIZE:
+        _field_paths_cache.clear()
+    _field_paths_cache[key] = field_paths
+    return field_paths
+_field_paths_cache = {}
+
+
+def _is_deferred(obj, field):
+    return getattr(field, 'column', None) is not None \
+            and not field.many_to_many \
+            and field.attname not in obj.__dict__
+
+
+def matches_filter(obj, q):
+    """
+    Tells whether ``obj`` satisfies the Q object ``q``, either by
+    evaluating it in Python with :func:`qeval`, or in the database with a
+    single ``exists()`` query.
+
+    The ``PERMISSION_OBJECT_STRATEGY`` setting chooses between the two:
+    ``'python'``, ``'database'`` or ``'auto'`` (the default). In automatic
+    mode, the database is queried only when :func:`qeval` would need more
+    than one query to follow the relations of ``q`` that are not already
+    loaded on the object.
+
+    The two strategies differ for lookups of an AND node that span the same
+    multi-valued relation: in the database, they must all match the same
+    related object, while :func:`qeval` tests each of them on any related
+    object. The automatic mode therefore never queries the database for
+    such Q objects.
+    """
+    strategy = getattr(settings, 'PERMISSION_OBJECT_STRATEGY', 'auto')
+    if strategy == 'python' or obj.pk is None:
+        return qeval(obj, q)
+    elif strategy == 'auto':
+        paths = compile_q(q).paths
+        queries = _estimate_queries(obj, paths)
+        if queries is None or queries <= 1 \
+           or _spans_multivalued(type(obj), paths):
+            return qeval(obj, q)
+    if not _collectors:
+        return _query_filter(obj, q)
+    start = time.time()
+    result = _query_filter(obj, q)
+    _record('exists', _get_model_name(type(obj)), start, 1)
+    return result
+
+
+def _query_filter(obj, q):
+    return type(obj)._base_manager.using(obj._state.db) \
+            .filter(pk=obj.pk).filter(q).exists()
+
+
+def _estimate_queries(obj, paths):
+    """
+    Returns the number of queries that :func:`qeval` needs to follow the
+    attribute paths ``paths`` from ``obj``, given what is already loaded
+    on the object, or None if some path doesn't only go through model
+    fields.
+    """
+    queries = set()
+    for path in paths:
+        current = obj
+        model = type(obj)
+        for i, attr in enumerate(path):
+            try:
+                field = model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                return None
+            prefix = tuple(path[:i + 1])
+            if current is not None and _is_deferred(current, field):
+                # The deferred fields of an object are loaded together, see
+                # _load_deferred_fields().
+                queries.add(('deferred', id(current)))
+                if getattr(field, 'is_relation', False):
+                    queries.add(prefix)
+                break
+            if not getattr(field, 'is_relation', False):
+                break
+            if field.many_to_many or field.one_to_many:
+                manager = getattr(current, attr, None)
+                if not isinstance(manager, Manager) \
+                   or manager.all()._result_cache is None:
+                    # The rest of the path is fetched in a single query.
+                    queries.add(prefix)
+                    break
+                current = None
+            elif current is None:
+                queries.add(prefix)
+            elif getattr(field, 'attname', None) is not None and \
+                    current.__dict__.get(field.attname) is None:
+                # Null foreign key, nothing to follow.
+                break
+            elif hasattr(current, field.get_cache_name()):
+                current = getattr(current, field.get_cache_name())
+                if current is None:
+                    break
+            else:
+                queries.add(prefix)
+                current = None
+            model = field.related_model
+    return len(queries)
+
+
+# Compilation of Q objects into Python predicates
+
+def compile_q(q):
+    """
+    Compiles a Q object into a predicate that takes an instance of a model
+    and returns True if the instance satisfies the Q object.
 
-    # Evaluate all children
+    Compiled predicates are cached by the structure of the Q object, so
+    compiling an equivalent Q object again is just a dictionary lookup.
+    """
+    return _get_compiled(q, _compile_node, _compiled_q_cache)
+_compiled_q_cache = {}
+COMPILED_Q_CACHE_SIZE = 1000
+
+
+def _get_compiled(q, compile, cache):
+    try:
+        key = _q_key(q)
+    except TypeError:
+        # Some value can't be hashed, don't cache.
+        return compile(q)
+    try:
+        return cache[key]
+    except KeyError:
+        if len(cache) >= COMPILED_Q_CACHE_SIZE:
+            cache.clear()
+        compiled = cache[key] = compile(q)
+        return compiled
+
+
+def _q_key(q):
+    """
+    Returns a hashable key describing the structure and the values of
+    ``q``.
+
+    Raises TypeError if one of the values can't be hashed.
+    """
+    children = []
     for child in q.children:
         if isinstance(child, Q):
-            result = qeval(obj, child)
+            children.append(_q_key(child))
         else:
             filter, value = child
-            bits = filter.split('__')
-            path = bits[:-1]
-            lookup = bits[-1]
-
-            # Traverse the attribute path and find all candidate values
-            candidates = [obj]
-            for attr in path:
-                candidates = list(itertools.chain.from_iterable(
-                    q_getattr(x, attr) for x in candidates
-                ))
-
-            if lookup == 'exact':
-                result = any(x == value for x in candidates)
-            elif lookup == 'iexact':
-                result = any(x.lower() == value.lower() for x in candidates)
-            elif lookup == 'contains':
-                result = any(value in x for x in candidates)
-            elif lookup == 'icontains':
-                result = any(value.lower() in x.lower() for x in candidates)
-            elif lookup == 'in':
-                result = any(x in value for x in candidates)
-            elif lookup == 'gt':
-                result = any(x > value for x in candidates)
-            elif lookup == 'gte':
-                result = any(x >= value for x in candidates)
-            elif lookup == 'lt':
-                result = any(x < value for x in candidates)
-            elif lookup == 'lte':
-                result = any(x <= value for x in candidates)
-            elif lookup == 'startswith':
-                result = any(x.startswith(value) for x in candidates)
-            elif lookup == 'istartswith':
-                result = any(
-                    x.lower().istartswith(value.lower())
-                    for x in candidates
-                )
-            elif lookup == 'endswith':
-                result = any(
-                    x.lower().iendswith(value.lower()) for x in candidates
-                )
-            elif lookup == 'range':
-                result = any(value[0] <= x <= value[1] for x in candidates)
-            elif lookup == 'year':
-                result = any(x.year == value for x in candidates)
-            elif lookup == 'month':
-                result = any(x.month == value for x in candidates)
-            elif lookup == 'day':
-                result = any(x.day == value for x in candidates)
-            elif lookup == 'week_day':
-                result = any(
-                    (x.weekday() + 1) % 7 + 1 == value for x in candidates
-                )
-            elif lookup == 'isnull':
-                if value:
-                    return not candidates
-                else:
-                    return bool(candidates)
-            elif lookup == 'search':
-                raise NotImplementedError(
-                    'qeval does not implement "__search"'
-                )
-            elif lookup == 'regex':
-                result = any(bool(re.search(value, x)) for x in candidates)
-            elif lookup == 'iregex':
-                result = any(
-                    bool(re.search(value, x, re.I)) for x in candidates
-                )
+            children.append((filter, _value_key(value)))
+    return (q.connector, q.negated, tuple(children))
+
+
+def _value_key(value):
+    if isinstance(value, QuerySet):
+        raise TypeError('querysets are not cacheable')
+    elif isinstance(value, (list, tuple)):
+        return (tuple, tuple(_value_key(v) for v in value))
+    elif isinstance(value, (set, frozenset)):
+        return (frozenset, frozenset(_value_key(v) for v in value))
+    else:
+        hash(value)
+        return (type(value), value)
+
+
+def _compile_node(q):
+    predicates = [
+        _compile_node(child) if isinstance(child, Q)
+        else _compile_leaf(*child)
+        for child in q.children
+    ]
+    negated = q.negated
+
+    if q.connector == Q.OR:
+        def predicate(obj):
+            for p in predicates:
+                if p(obj):
+                    return not negated
+            return negated
+    else:
+        def predicate(obj):
+            for p in predicates:
+                if not p(obj):
+                    return negated
+            return not negated
+    predicate.paths = [path for p in predicates for path in p.paths]
+    return predicate
+
+
+def _compile_leaf(filter, value):
+    path, test = _parse_leaf(filter, value)
+    if not path:
+        predicate = lambda obj: test([obj])
+    else:
+        predicate = lambda obj: test(_follow([obj], path, flat=True))
+    predicate.paths = [path] if path else []
+    return predicate
+
+
+def _parse_leaf(filter, value):
+    """
+    Splits the filter of a Q object leaf into an attribute path and a test
+    function for the candidates found at the end of the path.
+    """
+    bits = filter.split('__')
+    if bits[-1] in _LOOKUPS:
+        path, lookup = bits[:-1], bits[-1]
+    else:
+        path, lookup = bits, 'exact'
+    if lookup == 'exact' and value is None:
+        lookup, value = 'isnull', True
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        value = type(value)(_get_pk_or_value(v) for v in value)
+    else:
+        value = _get_pk_or_value(value)
+    return path, _LOOKUPS[lookup](value)
+
+
+def _get_pk_or_value(value):
+    # Like in the database, related objects are compared by primary key,
+    # so that a foreign key matches both an instance and its primary key.
+    return value.pk if isinstance(value, Model) else value
+
+
+def _follow(objs, path, flat=False):
+    """
+    Follows the attribute path ``path`` from every object of ``objs`` and
+    returns the list of values found at the end of the path.
+
+    Related managers are followed through their prefetched objects when
+    there are some. Otherwise, if ``flat`` is true, the rest of the path is
+    fetched with a single ``values_list()`` query. Either way, the model
+    instances found at the end of the path are replaced with their primary
+    key, as ``values_list()`` returns them.
+    """
+    done = []
+    for i, attr in enumerate(path):
+        rest = '__'.join(path[i + 1:])
+        found = []
+        for x in objs:
+            y = getattr(x, attr) if not _collectors else _getattr(x, attr)
+            if y is None:
+                continue
+            elif isinstance(y, Manager):
+                queryset = y.all()
+                if _collectors and queryset._result_cache is None:
+                    _count_relation_query()
+                if flat and rest and queryset._result_cache is None:
+                    try:
+                        values = queryset.values_list(rest, flat=True)
+                    except FieldError:
+                        # Not a database field, follow the attributes.
+                        pass
+                    else:
+                        done.extend(v for v in values if v is not None)
+                        continue
+                found.extend(queryset)
             else:
-                candidates = list(itertools.chain.from_iterable(
-                    q_getattr(x, lookup) for x in candidates
-                ))
-                result = any(x == value for x in candidates)
-
-        # See if we can shortcut
-        if (result and q.connector == Q.OR) \
-           or (not result and q.connector == Q.AND):
-            break
+                found.append(y)
+        objs = found
+    return done + [_get_pk_or_value(obj) for obj in objs]
+
+
+# Materialized permissions
+
+def get_materialized_perms(model):
+    """
+    Returns the permissions on ``model`` that are materialized according to
+    the ``PERMISSION_MATERIALIZED`` setting.
+    """
+    config = getattr(settings, 'PERMISSION_MATERIALIZED', None)
+    if not config:
+        return ()
+    label = _get_model_label(model)
+    for key, perms in config.iteritems():
+        if key.lower() == label:
+            return perms
+    return ()
+
+
+def get_materialized_role_key(role):
+    """
+    Returns the key identifying ``role`` in the materialized permission
+    tables, or None if the role has no cache key.
+    """
+    get_cache_key = getattr(role, 'get_cache_key', None)
+    key = get_cache_key() if get_cache_key is not None else None
+    if key is None:
+        return None
+    cls = type(role)
+    return hashlib.md5(
+        '%s.%s:%r' % (cls.__module__, cls.__name__, key)
+    ).hexdigest()
+
+
+def get_all_roles():
+    """
+    Returns the roles of all the users that can be materialized, as a
+    dictionary mapping their keys to the roles.
+    """
+    roles = {}
+    for users in _batches(_get_user_model()._default_manager.iterator()):
+        for user_roles in get_roles_many(users):
+            for role in user_roles:
+                key = get_materialized_role_key(role)
+                if key is not None:
+                    roles.setdefault(key, role)
+    return roles
+
+
+def rebuild_permissions(model, roles=None, batch_size=None):
+    """
+    Rebuilds the materialized permissions on ``model``.
+
+    The role filters are evaluated live while the table is rebuilt. When
+    ``roles`` is not given, the roles of all the users are collected with
+    :func:`get_all_roles`.
+    """
+    MaterializedPermission, MaterializedRole = _get_materialized_models()
+    perms = get_materialized_perms(model)
+    if roles is None:
+        roles = get_all_roles()
+    batch_size = batch_size or MATERIALIZE_BATCH_SIZE
+    content_type = _get_content_type(model)
+    MaterializedRole.objects.filter(content_type=content_type).delete()
+    MaterializedPermission.objects.filter(content_type=content_type).delete()
+    for perm in perms:
+        for key, role in roles.iteritems():
+            q = get_role_filter(role, perm, model)
+            if not isinstance(q, Q):
+                # Booleans are cheaper to evaluate than a semi-join.
+                continue
+            # Filters across multi-valued relations give duplicate rows.
+            queryset = model._base_manager.filter(q) \
+                    .order_by('pk').values_list('pk', flat=True).distinct()
+            pks = list(queryset[:batch_size])
+            while pks:
+                MaterializedPermission.objects.bulk_create([
+                    MaterializedPermission(
+                        role_key=key, perm=perm, content_type=content_type,
+                        object_id=pk
+                    )
+                    for pk in pks
+                ])
+                pks = list(queryset.filter(pk__gt=pks[-1])[:batch_size])
+            MaterializedRole.objects.create(
+                role_key=key, perm=perm, content_type=content_type
+            )
+
+
+def refresh_permissions(model, pks, roles=None, batch_size=None):
+    """
+    Refreshes the materialized permissions on the objects of ``model``
+    whose primary keys are in ``pks``, in batches of ``batch_size``
+    objects.
+
+    Only the rows of the materialized roles found in ``roles`` (all the
+    roles by default) are replaced.
+    """
+    MaterializedPermission, MaterializedRole = _get_materialized_models()
+    content_type = _get_content_type(model)
+    materialized = list(MaterializedRole.objects.filter(
+        content_type=content_type
+    ).values_list('role_key', 'perm'))
+    if not materialized:
+        return
+    if roles is None:
+        roles = get_all_roles()
+    # Only the rows of the roles found in ``roles`` are recomputed. The
+    # roles that have disappeared since the last rebuild keep their rows.
+    refreshed = [
+        (key, perm, roles[key]) for key, perm in materialized if key in roles
+    ]
+    if not refreshed:
+        return
+    stale = Q()
+    for key, perm, role in refreshed:
+        stale |= Q(role_key=key, perm=perm)
+    batch_size = batch_size or MATERIALIZE_BATCH_SIZE
+    pks = list(pks)
+    for i in range(0, len(pks), batch_size):
+        batch = pks[i:i + batch_size]
+        rows = []
+        for key, perm, role in refreshed:
+            q = get_role_filter(role, perm, model)
+            if q is True:
+                q = Q()
+            elif not isinstance(q, Q):
+                continue
+            rows.extend(
+                MaterializedPermission(
+                    role_key=key, perm=perm, content_type=content_type,
+                    object_id=pk
+                )
+                for pk in model._base_manager.filter(q, pk__in=batch)
+                .values_list('pk', flat=True).distinct()
+            )
+        with _atomic():
+            MaterializedPermission.objects.filter(
+                stale, content_type=content_type, object_id__in=batch
+            ).delete()
+            MaterializedPermission.objects.bulk_create(rows)
+MATERIALIZE_BATCH_SIZE = 1000
 
-    # Negate if necessary
-    if q.negated:
-        return not result
+
+def _get_materialized_filter(roles, perm, model, subqueries=False):
+    """
+    Same as :func:`_get_roles_filter`, but the objects selected by the
+    materialized roles are found with a semi-join on the materialized
+    permission table.
+    """
+    MaterializedPermission, MaterializedRole = _get_materialized_models()
+    live = []
+    keyed = {}
+    for role in roles:
+        key = get_materialized_role_key(role)
+        if key is None:
+            live.append(role)
+        else:
+            keyed[key] = role
+    materialized = []
+    if keyed:
+        content_type = _get_content_type(model)
+        materialized = sorted(MaterializedRole.objects.filter(
+            content_type=content_type, perm=perm, role_key__in=list(keyed)
+        ).values_list('role_key', flat=True))
+        live.extend(
+            role for key, role in keyed.iteritems()
+            if key not in materialized
+        )
+    query = _get_sql_filter(
+        _get_roles_filter(live, perm, model), model, subqueries
+    )
+    if query is True or not materialized:
+        return query
+    q = Q(pk__in=MaterializedPermission.objects.filter(
+        content_type=content_type, perm=perm, role_key__in=materialized
+    ).values('object_id'))
+    return q | query if query else q
+
+
+def _get_materialized_models():
+    try:
+        from django.apps import apps
+    except ImportError:  # django < 1.7
+        pass
     else:
+        if not apps.is_installed('auf.django.permissions.materialized'):
+            raise ImproperlyConfigured(
+                'Materialized permissions require '
+                'auf.django.permissions.materialized in INSTALLED_APPS'
+            )
+    from auf.django.permissions.materialized.models import \
+            MaterializedPermission, MaterializedRole
+    return MaterializedPermission, MaterializedRole
+
+
+def _get_content_type(model):
+    from django.contrib.contenttypes.models import ContentType
+    return ContentType.objects.get_for_model(model)
+
+
+def _get_model_label(model):
+    opts = model._meta
+    return '%s.%s' % (opts.app_label, opts.object_name.lower())
+
+
+# Evaluation of Q objects on many instances at once
+
+def qeval_many(objs, q):
+    """
+    Evaluates a Q object on each of ``objs``, which must all be instances
+    of the same model, and returns the list of the results.
+
+    Each lookup of the Q object is evaluated on all the instances in a
+    single pass, and only on the instances for which the result is still
+    undecided. The related objects needed by the lookups are first loaded
+    with one query per relation using ``prefetch_related_objects()``.
+    """
+    objs = list(objs)
+    result = [False] * len(objs)
+    if not objs:
         return result
 
+    evaluate = _get_compiled(q, _compile_node_many, _compiled_many_cache)
+    model = type(objs[0])
+    lookups = set()
+    for path in evaluate.paths:
+        n = _count_relations(model, path)
+        if n:
+            lookups.add('__'.join(path[:n]))
+    # Prefetching a relation twice would query it twice, and prefetching
+    # "a__b" also prefetches "a".
+    lookups = [
+        lookup for lookup in lookups
+        if not any(l.startswith(lookup + '__') for l in lookups)
+    ]
+    if lookups:
+        prefetch_related_objects(objs, lookups)
+
+    for i in evaluate(objs, range(len(objs))):
+        result[i] = True
+    return result
+_compiled_many_cache = {}
+
+
+def _count_relations(model, path):
+    """
+    Returns the number of attributes at the beginning of ``path`` that are
+    relations of ``model``, following the relations.
+    """
+    n = 0
+    for attr in path:
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            break
+        model = getattr(field, 'related_model', None)
+        if not getattr(field, 'is_relation', False) or model is None:
+            break
+        n += 1
+    return n
+
+
+def _compile_node_many(q):
+    """
+    Compiles a Q object into a function that takes a list of instances and
+    a list of indices in that list, and returns the indices of the
+    instances that satisfy the Q object.
+    """
+    evaluators = [
+        _compile_node_many(child) if isinstance(child, Q)
+        else _compile_leaf_many(*child)
+        for child in q.children
+    ]
+    negated = q.negated
+
+    if q.connector == Q.OR:
+        def evaluate(objs, indices):
+            matched = set()
+            remaining = indices
+            for e in evaluators:
+                if not remaining:
+                    break
+                matched.update(e(objs, remaining))
+                remaining = [i for i in remaining if i not in matched]
+            return remaining if negated else sorted(matched)
+    else:
+        def evaluate(objs, indices):
+            remaining = indices
+            for e in evaluators:
+                if not remaining:
+                    break
+                remaining = e(objs, remaining)
+            if negated:
+                remaining = set(remaining)
+                return [i for i in indices if i not in remaining]
+            return remaining
+
+    evaluate.paths = [path for e in evaluators for path in e.paths]
+    return evaluate
+
+
+def _compile_leaf_many(filter, value):
+    path, test = _parse_leaf(filter, value)
+
+    if not path:
+        def evaluate(objs, indices):
+            return [i for i in indices if test([objs[i]])]
+    else:
+        def evaluate(objs, indices):
+            return [i for i in indices if test(_follow([objs[i]], path))]
+
+    evaluate.paths = [path] if path else []
+    return evaluate
+
+
+# Lookups. Each lookup takes the value of the filter and returns a function
+# that tests a list of candidates.
+
+def _any(test):
+    return lambda candidates: any(test(x) for x in candidates)
+
+
+def _lookup_in(value):
+    try:
+        value = frozenset(value)
+    except TypeError:
+        value = tuple(value)
+    return _any(lambda x: x in value)
+
+
+def _lookup_isnull(value):
+    if value:
+        return lambda candidates: not candidates
+    else:
+        return bool
+
+
+def _lookup_search(value):
+    raise NotImplementedError('qeval does not implement "__search"')
+
+
+def _lookup_regex(value, flags=0):
+    regex = re.compile(value, flags)
+    return _any(lambda x: regex.search(x) is not None)
+
+
+_LOOKUPS = {
+    'exact': lambda value: _any(lambda x: x == value),
+    'iexact': lambda value: _any(
+        lambda x, value=value.lower(): x.lower() == value
+    ),
+    'contains': lambda value: _any(lambda x: value in x),
+    'icontains': lambda value: _any(
+        lambda x, value=value.lower(): value in x.lower()
+    ),
+    'in': _lookup_in,
+    'gt': lambda value: _any(lambda x: x > value),
+    'gte': lambda value: _any(lambda x: x >= value),
+    'lt': lambda value: _any(lambda x: x < value),
+    'lte': lambda value: _any(lambda x: x <= value),
+    'startswith': lambda value: _any(lambda x: x.startswith(value)),
+    'istartswith': lambda value: _any(
+        lambda x, value=value.lower(): x.lower().startswith(value)
+    ),
+    'endswith': lambda value: _any(lambda x: x.endswith(value)),
+    'iendswith': lambda value: _any(
+        lambda x, value=value.lower(): x.lower().endswith(value)
+    ),
+    'range': lambda value: _any(lambda x: value[0] <= x <= value[1]),
+    'year': lambda value: _any(lambda x: x.year == value),
+    'month': lambda value: _any(lambda x: x.month == value),
+    'day': lambda value: _any(lambda x: x.day == value),
+    'week_day': lambda value: _any(
+        lambda x: (x.weekday() + 1) % 7 + 1 == value
+    ),
+    'isnull': _lookup_isnull,
+    'search': _lookup_search,
+    'regex': _lookup_regex,
+    'iregex': lambda value: _lookup_regex(value, re.I),
+}
+
+
+# Simplification of Q objects
+
+def simplify_q(q, model=None):
+    """
+    Returns a Q object equivalent to ``q``, but simpler to evaluate.
+
+    Nested nodes with the same connector are flattened, duplicate children
+    are removed, ``exact`` and ``in`` lookups on the same field are merged
+    into a single ``in`` lookup and branches that are subsumed by one of
+    their siblings are dropped.
+
+    Lookups are only merged when they are known to apply to a field: when
+    ``model`` is given, the fields are looked up in its metadata, otherwise
+    only lookups on fields of the model itself are merged.
+    """
+    children = []
+    for child in q.children:
+        if isinstance(child, Q):
+            child = simplify_q(child, model)
+            if not child.negated and (
+                child.connector == q.connector or len(child.children) == 1
+            ):
+                children.extend(child.children)
+                continue
+        children.append(child)
+
+    if q.connector == Q.OR:
+        children = _merge_in_lookups(children, model)
+    children = _remove_duplicates(children)
+    children = _remove_absorbed(children, q.connector)
+
+    if len(children) == 1 and isinstance(children[0], Q):
+        child = children[0]
+        if q.negated:
+            return _make_q(child.children, child.connector, not child.negated)
+        else:
+            return child
+    return _make_q(children, q.connector, q.negated)
+
+
+def _make_q(children, connector, negated):
+    q = Q()
+    q.children = children
+    q.connector = connector
+    q.negated = negated
+    return q
+
+
+def _child_key(child):
+    try:
+        if isinstance(child, Q):
+            return _q_key(child)
+        else:
+            filter, value = child
+            return (filter, _value_key(value))
+    except TypeError:
+        return ('id', id(child))
+
+
+def _remove_duplicates(children):
+    seen = set()
+    result = []
+    for child in children:
+        key = _child_key(child)
+        if key not in seen:
+            seen.add(key)
+            result.append(child)
+    return result
+
+
+def _merge_in_lookups(children, model=None):
+    """
+    Merges the ``exact`` and ``in`` lookups on the same field of an OR
+    node into a single ``in`` lookup.
+    """
+    groups = {}
+    for child in children:
+        field = _in_lookup_field(child, model)
+        if field is not None:
+            groups.setdefault(field, []).append(child)
+
+    result = []
+    for child in children:
+        field = _in_lookup_field(child, model)
+        if field is None or len(groups[field]) == 1:
+            result.append(child)
+        elif groups[field]:
+            values = []
+            for filter, value in groups[field]:
+                if not filter.endswith('__in'):
+                    value = [value]
+                for v in value:
+                    if v not in values:
+                        values.append(v)
+            result.append((field + '__in', values))
+            groups[field] = []
+    return result
+
+
+def _in_lookup_field(child, model=None):
+    """
+    Returns the field of a leaf that can be merged into an ``in`` lookup,
+    or None.
+    """
+    if isinstance(child, Q):
+        return None
+    filter, value = child
+    if filter.endswith('__in'):
+        if not isinstance(value, (list, tuple, set, frozenset)):
+            return None
+        field = filter[:-len('__in')]
+    elif value is None or isinstance(value, QuerySet) \
+            or hasattr(value, 'resolve_expression'):
+        return None
+    elif filter.endswith('__exact'):
+        field = filter[:-len('__exact')]
+    else:
+        field = filter
+    return field if _is_field_path(model, field) else None
+
+
+def _is_field_path(model, path):
+    """
+    Tells whether ``path`` only names fields, following the relations from
+    ``model``. Without a model, only a single name is considered a field,
+    since the last part of a longer path could be a lookup or a transform.
+    """
+    bits = path.split('__')
+    if model is None:
+        return len(bits) == 1
+    for attr in bits:
+        if model is None:
+            return False
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            return False
+        model = getattr(field, 'related_model', None) \
+                if getattr(field, 'is_relation', False) else None
+    return True
+
+
+def _remove_absorbed(children, connector):
+    """
+    Drops the children that are subsumed by one of their siblings, e.g.
+    ``a OR (a AND b)`` is ``a`` and ``a AND (a OR b)`` is ``a``.
+    """
+    terms = []
+    for child in children:
+        if isinstance(child, Q) and not child.negated \
+           and child.connector != connector:
+            terms.append(frozenset(_child_key(c) for c in child.children))
+        else:
+            terms.append(frozenset([_child_key(child)]))
+    return [
+        child for i, child in enumerate(children)
+        if not any(
+            terms[j] < terms[i] for j in range(len(children)) if j != i
+        )
+    ]
+
+
+# Rewriting of multi-valued lookups into subqueries
+
+def rewrite_subqueries(q, model):
+    """
+    Returns a Q object equivalent to ``q`` on ``model`` in which the
+    lookups that span multi-valued relations (many-to-many fields and
+    reverse foreign keys) are replaced by ``pk__in`` subqueries.
+
+    Filtering across such relations joins the related tables and returns
+    an object once per matching related object. The rewritten Q object
+    doesn't add any join to the filtered queryset, which then never needs
+    ``distinct()``. The lookups of an AND node that span the same relation
+    go into the same subquery so that they still apply to the same related
+    object.
+    """
+    children = []
+    groups = {}
+    for child in q.children:
+        if isinstance(child, Q):
+            children.append(rewrite_subqueries(child, model))
+            continue
+        prefix = _multivalued_prefix(model, child[0])
+        if prefix is None:
+            children.append(child)
+        elif q.connector == Q.AND and prefix in groups:
+            groups[prefix].append(child)
+        else:
+            groups[prefix] = [child]
+            children.append(groups[prefix])
+    return _make_q([
+        ('pk__in', model._base_manager.filter(
+            _make_q(child, Q.AND, False)
+        ).values('pk')) if isinstance(child, list) else child
+        for child in children
+    ], q.connector, q.negated)
+
+
+def _multivalued_prefix(model, filter):
+    """
+    Returns the beginning of the lookup ``filter`` up to its first
+    multi-valued relation, or None if it doesn't span one.
+    """
+    bits = filter.split('__')
+    for i, attr in enumerate(bits):
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            return None
+        if getattr(field, 'many_to_many', False) \
+           or getattr(field, 'one_to_many', False):
+            return '__'.join(bits[:i + 1])
+        model = getattr(field, 'related_model', None)
+        if not getattr(field, 'is_relation', False) or model is None:
+            return None
+    return None
+
+
+def _spans_multivalued(model, paths):
+    return any(
+        _multivalued_prefix(model, '__'.join(path)) is not None
+        for path in paths
+    )
+
+
+# Instrumentation
+
+class Collector(object):
+    """
+    Base class for collectors of statistics about permission checking.
+
+    Collectors are registered with :func:`add_collector`.
+    """
+
+    def record(self, event, name, duration, queries=0):
+        """
+        Records one call. ``event`` is one of ``'provider'``,
+        ``'has_perm'``, ``'get_filter_for_perm'``, ``'qeval'``,
+        ``'exists'``, ``'deferred_load'``, ``'avoided_deferred_load'`` and
+        ``'queryset_with_perm'``. ``name`` is the name of the role provider,
+        of the role class or of the model involved. ``duration`` is the wall
+        time of the call in seconds and ``queries`` the number of relation
+        queries triggered by ``qeval``. Since querysets are lazy, the time
+        of ``'queryset_with_perm'`` only covers building the filter, not
+        running the query.
+        """
+        pass
+
+
+class InMemoryCollector(Collector):
+    """
+    A collector that aggregates the number of calls, the total time and the
+    number of queries per event and name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def record(self, event, name, duration, queries=0):
+        with self.lock:
+            stats = self.stats.get((event, name))
+            if stats is None:
+                stats = self.stats[(event, name)] = {
+                    'event': event, 'name': name,
+                    'calls': 0, 'time': 0.0, 'queries': 0,
+                }
+            stats['calls'] += 1
+            stats['time'] += duration
+            stats['queries'] += queries
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def dump(self):
+        """
+        Returns the statistics as a list of dictionaries, the most time
+        consuming first.
+        """
+        with self.lock:
+            stats = [dict(s) for s in self.stats.itervalues()]
+        stats.sort(key=lambda s: s['time'], reverse=True)
+        return stats
+
+
+def add_collector(collector):
+    """
+    Starts sending statistics to ``collector``.
+    """
+    if collector not in _collectors:
+        _collectors.append(collector)
+
+
+def remove_collector(collector):
+    """
+    Stops sending statistics to ``collector``.
+    """
+    if collector in _collectors:
+        _collectors.remove(collector)
+_collectors = []
+
+
+def _record(event, name, start, queries=0):
+    duration = time.time() - start
+    for collector in _collectors:
+        collector.record(event, name, duration, queries)
+
+
+def _get_name(obj):
+    if not hasattr(obj, '__name__'):
+        # Callable instances, functools.partial objects...
+        obj = type(obj)
+    return '%s.%s' % (getattr(obj, '__module__', None), obj.__name__)
+
+
+def _get_model_name(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def _get_relation_queries():
+    return getattr(_relation_queries, 'count', 0)
+
+
+def _count_relation_query():
+    _relation_queries.count = _get_relation_queries() + 1
+_relation_queries = threading.local()
+
+
+def _getattr(obj, attr):
+    """
+    Same as ``getattr(obj, attr)``, but counts the query made when loading
+    a related object that is not cached yet.
+    """
+    is_cached = getattr(getattr(type(obj), attr, None), 'is_cached', None)
+    fetched = is_cached is not None and not is_cached(obj)
+    value = getattr(obj, attr)
+    if fetched and value is not None:
+        _count_relation_query()
+    return value
+
 
 # Authentication backend
 
@@ -247,6 +2030,11 @@ class AuthenticationBackend(object):
     def has_module_perms(self, user, package_name):
         return user_has_perm(user, package_name)
 
+    def get_all_permissions(self, user, obj=None):
+        if obj is not None:
+            return frozenset()
+        return get_global_perms(user)[0]
+
     def authenticate(self, username=None, password=None):
         # We don't authenticate
         return None
@@ -1,17 +1,128 @@
 # encoding: utf-8
 
 from django.contrib.admin import ModelAdmin
+from django.contrib.admin.actions import delete_selected
+from django.contrib.admin.views.main import ChangeList
+
+from auf.django.permissions import has_perm_many
+
+
+class GuardedChangeList(ChangeList):
+    """
+    A changelist that computes the row-level permissions of the objects
+    shown on the current page in bulk, the first time one of them is
+    needed.
+    """
+
+    def get_results(self, request):
+        super(GuardedChangeList, self).get_results(request)
+        self.row_perms = RowPerms(request, list(self.result_list))
+        # The queryset is already filtered on the "change" permission.
+        self.row_perms['change'] = dict(
+            (pk, True) for pk in self.row_perms.pks
+        )
+        _get_row_perm_pages(request)[self.model] = self.row_perms
+
+
+class RowPerms(dict):
+    """
+    Maps each permission to the permissions of the user on the objects of
+    a changelist page, as a dictionary keyed by primary key. The
+    permissions are computed in bulk when first looked up.
+    """
+
+    def __init__(self, request, objs):
+        self.request = request
+        self.objs = objs
+        self.pks = set(obj.pk for obj in objs)
+
+    def __setitem__(self, perm, perms):
+        super(RowPerms, self).__setitem__(perm, perms)
+        cache = _get_row_perm_cache(self.request)
+        for obj in self.objs:
+            cache[(perm, type(obj), obj.pk)] = perms[obj.pk]
+
+    def __missing__(self, perm):
+        self[perm] = has_perm_many(self.request.user, perm, self.objs)
+        return dict.__getitem__(self, perm)
 
 
 class GuardedModelAdmin(ModelAdmin):
 
     def has_change_permission(self, request, obj=None):
         if obj is not None:
-            return request.user.has_perm('change', obj)
+            return _has_row_perm(request, 'change', obj)
         else:
             return super(GuardedModelAdmin, self) \
                     .has_change_permission(request, obj)
 
-    def queryset(self, request):
+    def has_delete_permission(self, request, obj=None):
+        if obj is not None:
+            return _has_row_perm(request, 'delete', obj)
+        else:
+            return super(GuardedModelAdmin, self) \
+                    .has_delete_permission(request, obj)
+
+    def get_queryset(self, request):
+        return super(GuardedModelAdmin, self).get_queryset(request) \
+                .with_perm(request.user, 'change')
+
+    def queryset(self, request):  # django < 1.6
         return super(GuardedModelAdmin, self).queryset(request) \
                 .with_perm(request.user, 'change')
+
+    def get_changelist(self, request, **kwargs):
+        return GuardedChangeList
+
+    def get_actions(self, request):
+        actions = super(GuardedModelAdmin, self).get_actions(request)
+        if 'delete_selected' in actions:
+            func, name, description = actions['delete_selected']
+            if func is delete_selected:
+                actions[name] = (guarded_delete_selected, name, description)
+        return actions
+
+
+def guarded_delete_selected(modeladmin, request, queryset):
+    """
+    Same as the ``delete_selected`` admin action, but only deletes the
+    selected objects on which the user has the "delete" permission.
+    """
+    perms = has_perm_many(request.user, 'delete', queryset)
+    queryset = queryset.filter(
+        pk__in=[pk for pk, result in perms.iteritems() if result]
+    )
+    return delete_selected(modeladmin, request, queryset)
+guarded_delete_selected.short_description = \
+        delete_selected.short_description
+
+
+def _get_row_perm_cache(request):
+    try:
+        return request._row_perm_cache
+    except AttributeError:
+        request._row_perm_cache = {}
+        return request._row_perm_cache
+
+
+def _get_row_perm_pages(request):
+    try:
+        return request._row_perm_pages
+    except AttributeError:
+        request._row_perm_pages = {}
+        return request._row_perm_pages
+
+
+def _has_row_perm(request, perm, obj):
+    cache = _get_row_perm_cache(request)
+    key = (perm, type(obj), obj.pk)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    row_perms = _get_row_perm_pages(request).get(type(obj))
+    if row_perms is not None and obj.pk in row_perms.pks:
+        # Compute the permission for the whole changelist page at once.
+        return row_perms[perm][obj.pk]
+    result = cache[key] = request.user.has_perm(perm, obj)
+    return result
@@ -1,18 +1,61 @@
-from django.contrib.auth.decorators import user_passes_test
+from functools import wraps
+
+from django.core.exceptions import PermissionDenied
+from django.db.models import Manager
+from django.db.models.query import QuerySet
 from django.shortcuts import get_object_or_404
+from django.utils.decorators import available_attrs
+
+from auf.django.permissions import queryset_with_perm
+
 
 def get_object(cls, perm=None, key='pk', arg=0, kwarg=None):
     def decorator(view_func):
+        @wraps(view_func, assigned=available_attrs(view_func))
         def wrapped_view(request, *args, **kwargs):
             key_val = kwargs[kwarg] if kwarg else args[arg]
-            obj = get_object_or_404(cls, **{key: key_val})
+            obj = _get_object(request.user, cls, perm, {key: key_val})
             args = list(args)      # Make args mutable
             if kwarg:
                 del kwargs[kwarg]
             else:
                 del args[arg]
             args.insert(0, obj)
-            f = user_passes_test(lambda user: user.has_perm(perm, obj))(view_func) if perm else view_func
-            return f(request, *args, **kwargs)
+            return view_func(request, *args, **kwargs)
         return wrapped_view
     return decorator
+
+
+def _get_object(user, cls, perm, lookup):
+    """
+    Fetches the object matching ``lookup`` on which ``user`` has the
+    permission ``perm``.
+
+    Raises Http404 if there is no such object and PermissionDenied if the
+    user doesn't have the permission on it.
+    """
+    if perm is None:
+        return get_object_or_404(cls, **lookup)
+
+    if isinstance(cls, QuerySet):
+        queryset = cls
+    elif isinstance(cls, Manager):
+        queryset = cls.all()
+    else:
+        queryset = cls._default_manager.all()
+
+    # Most of the time, the role filters give the permission and a single
+    # query is enough. The filters may join multi-valued relations, so they
+    # go into a subquery.
+    allowed = queryset_with_perm(queryset, user, perm).values('pk')
+    try:
+        return queryset.filter(pk__in=allowed).get(**lookup)
+    except queryset.model.DoesNotExist:
+        pass
+
+    # The permission may still come from the roles' has_perm() or from
+    # another authentication backend.
+    obj = get_object_or_404(queryset, **lookup)
+    if not user.has_perm(perm, obj):
+        raise PermissionDenied
+    return obj
@@ -0,0 +1,9 @@
+"""
+Optional application holding the materialized permission tables.
+
+Add it to ``INSTALLED_APPS`` to use the ``PERMISSION_MATERIALIZED``
+setting.
+"""
+
+default_app_config = \
+        'auf.django.permissions.materialized.apps.MaterializedConfig'
@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class MaterializedConfig(AppConfig):
+    name = 'auf.django.permissions.materialized'
+    label = 'permissions_materialized'
+    verbose_name = 'Materialized permissions'
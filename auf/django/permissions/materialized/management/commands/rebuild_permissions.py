@@ -0,0 +1,68 @@
+# encoding: utf-8
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+try:
+    from django.apps import apps
+except ImportError:  # django < 1.7
+    from django.db.models import get_model
+else:
+    get_model = apps.get_model
+
+from auf.django.permissions import get_all_roles, get_materialized_perms, \
+        rebuild_permissions, refresh_permissions
+
+
+class Command(BaseCommand):
+    args = '[app_label.model ...]'
+    help = (
+        'Rebuilds the materialized permissions of the given models, or of '
+        'all the models of the PERMISSION_MATERIALIZED setting.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', type='int', default=None,
+            help='number of objects processed at a time'
+        ),
+        make_option(
+            '--refresh', action='store_true', default=False,
+            help='refresh the existing rows in batches instead of '
+                 'rebuilding the table from scratch'
+        ),
+    )
+
+    def handle(self, *labels, **options):
+        if not labels:
+            labels = getattr(settings, 'PERMISSION_MATERIALIZED', {}).keys()
+        models = []
+        for label in labels:
+            try:
+                model = get_model(*label.split('.', 1))
+            except (LookupError, TypeError, ValueError):
+                model = None
+            if model is None:
+                raise CommandError('Unknown model: %s' % label)
+            if not get_materialized_perms(model):
+                raise CommandError(
+                    'No materialized permissions for %s' % label
+                )
+            models.append(model)
+
+        roles = get_all_roles()
+        batch_size = options['batch_size']
+        for model in models:
+            if options['refresh']:
+                queryset = model._base_manager.order_by('pk') \
+                        .values_list('pk', flat=True)
+                refresh_permissions(
+                    model, queryset.iterator(), roles, batch_size
+                )
+            else:
+                rebuild_permissions(model, roles, batch_size)
+            if int(options.get('verbosity', 1)) > 0:
+                self.stdout.write(
+                    'Materialized permissions of %s rebuilt.\n' %
+                    model._meta.object_name
+                )
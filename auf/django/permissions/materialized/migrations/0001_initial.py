@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterializedPermission',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('role_key', models.CharField(max_length=32)),
+                ('perm', models.CharField(max_length=100)),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MaterializedRole',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('role_key', models.CharField(max_length=32)),
+                ('perm', models.CharField(max_length=100)),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='materializedrole',
+            unique_together=set([('role_key', 'perm', 'content_type')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='materializedpermission',
+            unique_together=set([('role_key', 'perm', 'content_type', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='materializedpermission',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+    ]
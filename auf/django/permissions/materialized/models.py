@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+
+
+class MaterializedPermission(models.Model):
+    """
+    An object on which the roles identified by ``role_key`` give the
+    permission ``perm``.
+    """
+    role_key = models.CharField(max_length=32)
+    perm = models.CharField(max_length=100)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('role_key', 'perm', 'content_type', 'object_id')
+        index_together = [('content_type', 'object_id')]
+
+
+class MaterializedRole(models.Model):
+    """
+    Records that the objects on which the roles identified by ``role_key``
+    give the permission ``perm`` are stored as ``MaterializedPermission``
+    rows.
+    """
+    role_key = models.CharField(max_length=32)
+    perm = models.CharField(max_length=100)
+    content_type = models.ForeignKey(ContentType)
+
+    class Meta:
+        unique_together = ('role_key', 'perm', 'content_type')
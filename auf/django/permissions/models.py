@@ -3,7 +3,8 @@
 from django.db.models import Manager
 from django.db.models.query import QuerySet
 
-from auf.django.permissions import queryset_with_perm
+from auf.django.permissions import queryset_annotate_perms, \
+        queryset_with_perm
 
 
 # Add nice methods to the Django Queryset
@@ -15,5 +16,15 @@ def _manager_with_perm(manager, *args, **kwargs):
         return manager.get_queryset().with_perm(*args, **kwargs)
 
 
+def _manager_annotate_perms(manager, *args, **kwargs):
+    try:
+        return manager.get_query_set().annotate_perms(*args, **kwargs)
+    except AttributeError:  # django 1.8
+        return manager.get_queryset().annotate_perms(*args, **kwargs)
+
+
 Manager.with_perm = _manager_with_perm
+Manager.annotate_perms = _manager_annotate_perms
 QuerySet.with_perm = queryset_with_perm
+QuerySet.annotate_perms = queryset_annotate_perms
+
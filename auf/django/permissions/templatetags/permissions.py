@@ -1,8 +1,45 @@
 from django import template
 
+from auf.django.permissions import has_perm_many
+
 register = template.Library()
 
 
+def _get_user(context):
+    if 'user' in context:
+        return context['user']
+    else:
+        return context['request'].user
+
+
+def _get_perm_cache(user):
+    """
+    Returns the cache of object permissions kept on ``user`` for the
+    template tags.
+    """
+    try:
+        return user._obj_perm_cache
+    except AttributeError:
+        user._obj_perm_cache = {}
+        return user._obj_perm_cache
+
+
+def _has_perm(user, perm, obj):
+    """
+    Checks ``user.has_perm(perm, obj)``, remembering the result on the user
+    for the rest of the request.
+    """
+    if obj is None or obj.pk is None:
+        return user.has_perm(perm, obj)
+    cache = _get_perm_cache(user)
+    key = (perm, type(obj), obj.pk)
+    try:
+        return cache[key]
+    except KeyError:
+        result = cache[key] = user.has_perm(perm, obj)
+        return result
+
+
 class IfHasPermNode(template.Node):
 
     def __init__(self, perm, obj, nodelist_true, nodelist_false):
@@ -12,13 +49,10 @@ class IfHasPermNode(template.Node):
         self.nodelist_false = nodelist_false
 
     def render(self, context):
-        if 'user' in context:
-            user = context['user']
-        else:
-            user = context['request'].user
+        user = _get_user(context)
         perm = self.perm.resolve(context)
         obj = self.obj.resolve(context)
-        if user.has_perm(perm, obj):
+        if _has_perm(user, perm, obj):
             return self.nodelist_true.render(context)
         else:
             return self.nodelist_false.render(context)
@@ -32,10 +66,7 @@ class WithPermsNode(template.Node):
         self.nodelist = nodelist
 
     def render(self, context):
-        if 'user' in context:
-            user = context['user']
-        else:
-            user = context['request'].user
+        user = _get_user(context)
         obj = self.obj.resolve(context)
         context.update({self.var: PermWrapper(user, obj)})
         output = self.nodelist.render(context)
@@ -43,6 +74,26 @@ class WithPermsNode(template.Node):
         return output
 
 
+class PermsForNode(template.Node):
+
+    def __init__(self, objs, perm):
+        self.objs = template.Variable(objs)
+        self.perm = template.Variable(perm)
+
+    def render(self, context):
+        user = _get_user(context)
+        perm = self.perm.resolve(context)
+        objs = [
+            obj for obj in self.objs.resolve(context) if obj.pk is not None
+        ]
+        perms = has_perm_many(user, perm, objs)
+        cache = _get_perm_cache(user)
+        for obj in objs:
+            result = cache[(perm, type(obj), obj.pk)] = perms[obj.pk]
+            setattr(obj, 'can_%s' % perm, result)
+        return ''
+
+
 class PermWrapper(object):
 
     def __init__(self, user, obj):
@@ -50,7 +101,7 @@ class PermWrapper(object):
         self.obj = obj
 
     def __getitem__(self, perm):
-        return self.user.has_perm(perm, self.obj)
+        return _has_perm(self.user, perm, self.obj)
 
 
 @register.tag
@@ -83,3 +134,15 @@ def withperms(parser, token):
     nodelist = parser.parse(('endwithperms',))
     parser.delete_first_token()
     return WithPermsNode(obj, var, nodelist)
+
+
+@register.tag
+def permsfor(parser, token):
+    bits = token.split_contents()[1:]
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(
+            "%r tag takes two arguments: objects and permission" %
+            token.contents.split()[0]
+        )
+    objs, perm = bits
+    return PermsForNode(objs, perm)
@@ -0,0 +1,272 @@
+"""
+Benchmarks for the permission engine.
+
+Generates synthetic users, roles, foods and recipes in an in-memory SQLite
+database, times the main permission checking operations and writes the
+results as JSON. Run from the root of the repository with::
+
+    python -m tests.benchmarks --users 20 --roles 5 --foods 2000 \
+            --recipes 200 --fanout 5 --output results.json
+"""
+from __future__ import absolute_import
+
+import json
+import optparse
+import os
+import platform
+import random
+import sys
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+
+class BenchmarkRole(object):
+    """
+    A synthetic role giving permission to eat the foods whose name ends with
+    a given digit and the recipes of those foods that contain no meat.
+    """
+
+    def __init__(self, digit):
+        self.digit = digit
+
+    def has_perm(self, perm, obj=None):
+        return perm == 'read'
+
+    def get_filter_for_perm(self, perm, model):
+        from tests.simpletests.models import Food, Recipe
+        if perm == 'eat':
+            if model is Food:
+                return Q(name__endswith=str(self.digit))
+            elif model is Recipe:
+                return Q(name__endswith=str(self.digit)) & \
+                        ~Q(ingredients__is_meat=True)
+        return False
+
+    def get_cache_key(self):
+        return self.digit
+
+
+def benchmark_provider(user):
+    return [
+        BenchmarkRole((user.pk + i) % 10)
+        for i in range(benchmark_provider.roles)
+    ]
+benchmark_provider.roles = 1
+
+
+def setup_database(options):
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from tests.simpletests.models import Food, Recipe
+
+    call_command('migrate', verbosity=0, interactive=False)
+    rng = random.Random(options.seed)
+    User.objects.bulk_create([
+        User(username='user%d' % i) for i in range(options.users)
+    ])
+    users = list(User.objects.all())
+    Food.objects.bulk_create([
+        Food(
+            name='food-%06d' % i,
+            is_meat=(i % 3 == 0),
+            owner=users[i % len(users)],
+        )
+        for i in range(options.foods)
+    ])
+    Recipe.objects.bulk_create([
+        Recipe(name='recipe-%06d' % i) for i in range(options.recipes)
+    ])
+    food_ids = list(Food.objects.values_list('pk', flat=True))
+    Through = Recipe.ingredients.through
+    Through.objects.bulk_create([
+        Through(recipe_id=recipe_id, food_id=food_id)
+        for recipe_id in Recipe.objects.values_list('pk', flat=True)
+        for food_id in rng.sample(
+            food_ids, min(options.fanout, len(food_ids))
+        )
+    ])
+
+
+def measure(name, func, options, count):
+    """
+    Runs ``func`` ``options.repeat`` times and returns the best time along
+    with the number of queries of the last run.
+    """
+    best = None
+    for i in range(options.repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            func()
+            duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    result = {
+        'name': name,
+        'count': count,
+        'time': best,
+        'time_per_item': best / count if count else None,
+        'queries': len(queries),
+    }
+    sys.stderr.write(
+        '%-30s %8d items %10.4fs %8d queries\n' %
+        (name, count, best, len(queries))
+    )
+    return result
+
+
+def run(options):
+    from django.contrib.auth.models import User
+    from django.template import Context, Template
+    from auf.django import permissions
+    from auf.django.permissions import invalidate_roles, qeval, \
+            qeval_many, queryset_with_perm, user_has_perm, user_has_perm_many
+    from tests.simpletests.models import Food, Recipe
+
+    settings.ROLE_PROVIDERS = ('tests.benchmarks.benchmark_provider',)
+    permissions._role_providers = None
+    benchmark_provider.roles = options.roles
+    setup_database(options)
+
+    users = list(User.objects.all())
+    foods = list(Food.objects.all())
+    recipes = list(Recipe.objects.all())
+    results = []
+
+    def reset():
+        permissions.clear_filter_cache()
+        for user in users:
+            invalidate_roles(user)
+
+    def object_checks(objs):
+        def func():
+            reset()
+            for user in users:
+                for obj in objs:
+                    user_has_perm(user, 'eat', obj)
+        return func
+
+    results.append(measure(
+        'object_check_food', object_checks(foods), options,
+        len(users) * len(foods)
+    ))
+    results.append(measure(
+        'object_check_recipe', object_checks(recipes), options,
+        len(users) * len(recipes)
+    ))
+
+    def global_checks():
+        reset()
+        for user in users:
+            for i in range(100):
+                user_has_perm(user, 'read')
+    results.append(measure(
+        'global_check', global_checks, options, len(users) * 100
+    ))
+
+    def bulk_checks():
+        reset()
+        for user in users:
+            user_has_perm_many(user, 'eat', foods)
+    results.append(measure(
+        'bulk_check_food', bulk_checks, options, len(users) * len(foods)
+    ))
+
+    def queryset_filtering(model):
+        def func():
+            reset()
+            for user in users:
+                len(queryset_with_perm(
+                    model.objects.all(), user, 'eat'
+                ).values_list('pk', flat=True))
+        return func
+    results.append(measure(
+        'queryset_filter_food', queryset_filtering(Food), options, len(users)
+    ))
+    results.append(measure(
+        'queryset_filter_recipe', queryset_filtering(Recipe), options,
+        len(users)
+    ))
+
+    q = ~Q(ingredients__is_meat=True) | Q(name__endswith='0')
+
+    def qeval_page():
+        for recipe in Recipe.objects.all()[:options.page_size]:
+            qeval(recipe, q)
+
+    def qeval_many_page():
+        qeval_many(Recipe.objects.all()[:options.page_size], q)
+    count = min(options.page_size, len(recipes))
+    results.append(measure('qeval_page', qeval_page, options, count))
+    results.append(measure(
+        'qeval_many_page', qeval_many_page, options, count
+    ))
+
+    page = foods[:options.page_size]
+    loop = Template(
+        '{% load permissions %}{% for food in foods %}'
+        '{% ifhasperm "eat" food %}1{% else %}0{% endifhasperm %}'
+        '{% endfor %}'
+    )
+    bulk_loop = Template(
+        '{% load permissions %}{% permsfor foods "eat" %}'
+        '{% for food in foods %}'
+        '{% ifhasperm "eat" food %}1{% else %}0{% endifhasperm %}'
+        '{% endfor %}'
+    )
+
+    def render(template):
+        def func():
+            reset()
+            for user in users:
+                template.render(Context({'user': user, 'foods': page}))
+        return func
+    results.append(measure(
+        'template_ifhasperm', render(loop), options, len(users) * len(page)
+    ))
+    results.append(measure(
+        'template_permsfor', render(bulk_loop), options,
+        len(users) * len(page)
+    ))
+    return results
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m tests.benchmarks [options]')
+    parser.add_option('--users', type='int', default=10)
+    parser.add_option('--roles', type='int', default=3,
+                      help='number of roles per user')
+    parser.add_option('--foods', type='int', default=1000)
+    parser.add_option('--recipes', type='int', default=100)
+    parser.add_option('--fanout', type='int', default=5,
+                      help='number of ingredients per recipe')
+    parser.add_option('--page-size', type='int', default=100,
+                      help='number of objects rendered in templates')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--output', help='file to write the results to')
+    options, args = parser.parse_args(argv)
+
+    django.setup()
+    results = {
+        'options': vars(options),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'results': run(options),
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
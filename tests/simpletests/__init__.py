@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
-from auf.django.permissions import Role
+from auf.django.permissions import Role, register_role_dependency
+from django.contrib.auth.models import User
 from django.db.models import Q
 
 from tests.simpletests.models import Food, Recipe
@@ -13,9 +14,13 @@ def role_provider(user):
         return [HippieRole()]
     else:
         return []
+register_role_dependency(User, lambda user: [user])
 
 
 class VegetarianRole(Role):
+    handled_perms = ('eat', 'buy', 'throw', 'give', 'paint', 'change',
+                     'delete', 'cook')
+    handled_models = (Food, Recipe)
 
     def __init__(self, user):
         self.user = user
@@ -32,13 +37,24 @@ class VegetarianRole(Role):
                 return Q(is_meat=True) | Q(name__contains='canned')
             elif perm == 'paint':
                 return Q(owner__username__startswith='a')
+            elif perm == 'change':
+                return Q(is_meat=False)
+            elif perm == 'delete':
+                return Q(owner=self.user)
         elif model is Recipe:
             if perm == 'eat':
                 return ~Q(ingredients__is_meat=True)
+            elif perm == 'cook':
+                return Q(ingredients__is_meat=False) & \
+                        Q(ingredients__name__startswith='c')
         return False
 
 
 class HippieRole(Role):
+    handled_perms = ('eat', 'pray', 'love')
 
     def has_perm(self, perm, obj=None):
         return perm in ('eat', 'pray', 'love')
+
+    def get_perms(self):
+        return set(['eat', 'pray', 'love'])
@@ -1,8 +1,33 @@
 from __future__ import absolute_import
 
-from django.contrib.auth.models import User
-from django.test import TransactionTestCase
+import functools
+import time
 
+from django.contrib.admin import AdminSite
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.http import Http404, HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, TransactionTestCase
+from django.test.utils import override_settings
+
+from auf.django import permissions
+from auf.django.permissions.admin import GuardedChangeList, \
+        GuardedModelAdmin, guarded_delete_selected
+from auf.django.permissions.decorators import get_object
+from auf.django.permissions.materialized.models import \
+        MaterializedPermission
+from auf.django.permissions import InMemoryCollector, Role, \
+        add_collector, bump_roles_version, clear_filter_cache, compile_q, \
+        get_role_filter, get_roles, get_roles_for_perm, invalidate_roles, \
+        matches_filter, qeval, qeval_many, rebuild_permissions, \
+        refresh_permissions, remove_collector, rewrite_subqueries, \
+        simplify_q, user_has_perm_many, users_with_perm
+
+from tests.simpletests import HippieRole, VegetarianRole
 from tests.simpletests.models import Food, Recipe
 
 
@@ -34,6 +59,17 @@ class HasPermTestCase(TransactionTestCase):
         self.assertFalse(self.bob.has_perm('sleep'))
         self.assertFalse(self.alice.has_perm('eat'))
 
+    def test_module_and_all_permissions(self):
+        self.assertTrue(self.bob.has_module_perms('love'))
+        self.assertFalse(self.bob.has_module_perms('simpletests'))
+        self.assertEqual(
+            self.bob.get_all_permissions(), set(['eat', 'pray', 'love'])
+        )
+        self.assertEqual(self.alice.get_all_permissions(), set())
+        self.assertEqual(
+            self.bob.get_all_permissions(self.carrot), set()
+        )
+
     def test_object_permissions(self):
         self.assertTrue(self.alice.has_perm('eat', self.carrot))
         self.assertFalse(self.alice.has_perm('throw', self.carrot))
@@ -45,6 +81,100 @@ class HasPermTestCase(TransactionTestCase):
         self.assertTrue(self.alice.has_perm('eat', self.vegetable_soup))
         self.assertFalse(self.alice.has_perm('eat', self.beef_soup))
 
+    def test_deferred_instances(self):
+        carrot = Food.objects.only('id').get(pk=self.carrot.pk)
+        self.assertTrue(self.alice.has_perm('eat', carrot))
+        steak = Food.objects.defer('name').get(pk=self.steak.pk)
+        self.assertFalse(self.alice.has_perm('eat', steak))
+        self.assertEqual(
+            user_has_perm_many(self.alice, 'eat', [carrot, steak]),
+            {carrot.pk: True, steak.pk: False}
+        )
+
+    def test_relation_traversal_queries(self):
+        beef_soup = Recipe.objects.get(pk=self.beef_soup.pk)
+        with self.assertNumQueries(1):
+            self.assertFalse(qeval(beef_soup, ~Q(ingredients__is_meat=True)))
+        with self.assertNumQueries(1):
+            self.assertTrue(qeval(
+                beef_soup, Q(ingredients__owner__username='alice')
+            ))
+        beef_soup = Recipe.objects.prefetch_related('ingredients') \
+                .get(pk=self.beef_soup.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(qeval(beef_soup, ~Q(ingredients__is_meat=True)))
+
+    def test_object_strategy(self):
+        q = Q(name=u'carrot') & Q(owner__username='alice')
+        carrot = Food.objects.only('id').get(pk=self.carrot.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(matches_filter(carrot, q))
+        q = Q(owner__username='alice')
+        carrot = Food.objects.select_related('owner').get(pk=self.carrot.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(matches_filter(carrot, q))
+        with override_settings(PERMISSION_OBJECT_STRATEGY='database'):
+            with self.assertNumQueries(1):
+                self.assertTrue(matches_filter(carrot, q))
+        carrot = Food.objects.get(pk=self.carrot.pk)
+        with override_settings(PERMISSION_OBJECT_STRATEGY='python'):
+            with self.assertNumQueries(1):
+                self.assertTrue(matches_filter(carrot, q))
+
+    def test_object_strategy_multivalued(self):
+        # Python tests each lookup on any ingredient, the database wants
+        # a single ingredient matching both.
+        chicken = Food.objects.create(name=u'chicken', is_meat=True)
+        leek = Food.objects.create(name=u'leek', is_meat=False)
+        stew = Recipe.objects.create(name=u'stew')
+        stew.ingredients = [chicken, leek]
+        q = Q(ingredients__is_meat=False) & \
+                Q(ingredients__name__startswith='c')
+        for strategy, expected in [
+            ('auto', True), ('python', True), ('database', False)
+        ]:
+            with override_settings(PERMISSION_OBJECT_STRATEGY=strategy):
+                stew = Recipe.objects.get(pk=stew.pk)
+                self.assertEqual(matches_filter(stew, q), expected)
+                invalidate_roles(self.alice)
+                self.assertEqual(self.alice.has_perm('cook', stew), expected)
+
+    def test_related_values(self):
+        self.assertTrue(qeval(self.carrot, Q(owner=self.alice.pk)))
+        self.assertTrue(qeval(self.carrot, Q(owner__in=[self.alice])))
+        for value in [self.alice, self.alice.pk]:
+            q = Q(ingredients__owner=value)
+            soup = Recipe.objects.get(pk=self.beef_soup.pk)
+            self.assertTrue(qeval(soup, q))
+            soup = Recipe.objects.prefetch_related('ingredients') \
+                    .get(pk=self.beef_soup.pk)
+            self.assertTrue(qeval(soup, q))
+            self.assertEqual(
+                qeval_many(Recipe.objects.order_by('name'), q), [True, True]
+            )
+        q = Q(ingredients__in=[self.steak.pk])
+        self.assertEqual(
+            qeval_many(Recipe.objects.order_by('name'), q), [True, False]
+        )
+
+    def test_qeval_many(self):
+        recipes = list(Recipe.objects.order_by('name'))
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                qeval_many(recipes, ~Q(ingredients__is_meat=True)),
+                [False, True]
+            )
+        foods = list(Food.objects.order_by('name'))
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                qeval_many(
+                    foods,
+                    Q(owner__username__startswith='a') | Q(is_meat=True)
+                ),
+                [False, True, False, True]
+            )
+        self.assertEqual(qeval_many([], Q(is_meat=True)), [])
+
     def test_queryset_filtering(self):
         self.assertEqual(
             set(Food.objects.with_perm(self.alice, 'eat')),
@@ -63,8 +193,968 @@ class HasPermTestCase(TransactionTestCase):
             set()
         )
 
+    def test_bulk_object_permissions(self):
+        foods = [self.carrot, self.celery, self.steak, self.soup]
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                user_has_perm_many(self.alice, 'eat', foods),
+                {
+                    self.carrot.pk: True,
+                    self.celery.pk: True,
+                    self.steak.pk: False,
+                    self.soup.pk: True,
+                }
+            )
+        with self.assertNumQueries(0):
+            self.assertTrue(all(
+                user_has_perm_many(self.bob, 'eat', foods).values()
+            ))
+        self.assertEqual(user_has_perm_many(self.alice, 'eat', []), {})
+
+    def test_queryset_annotation(self):
+        foods = Food.objects.annotate_perms(
+            self.alice, ['eat', 'buy', 'throw']
+        )
+        self.assertEqual(
+            dict((f.name, (f.can_eat, f.can_buy, f.can_throw)) for f in foods),
+            {
+                u'carrot': (True, True, False),
+                u'celery': (True, True, False),
+                u'steak': (False, True, False),
+                u'canned soup': (True, True, False),
+            }
+        )
+        foods = Food.objects.annotate_perms(self.superman, ['eat'])
+        self.assertTrue(all(f.can_eat for f in foods))
+
+    def test_users_with_perm(self):
+        self.assertEqual(
+            set(users_with_perm(self.carrot, 'eat')),
+            set([self.alice, self.bob, self.superman])
+        )
+        self.assertEqual(
+            set(users_with_perm(self.steak, 'eat')),
+            set([self.bob, self.superman])
+        )
+        self.assertEqual(
+            users_with_perm(
+                self.carrot, 'eat', User.objects.filter(username='alice')
+            ),
+            [self.alice]
+        )
+        self.assertEqual(
+            users_with_perm(self.carrot, 'eat', [self.bob]), [self.bob]
+        )
+
+    def test_queryset_filtering_subqueries(self):
+        recipes = Recipe.objects.with_perm(self.alice, 'cook')
+        self.assertEqual(recipes.count(), 4)
+        with override_settings(PERMISSION_FILTER_SUBQUERIES=True):
+            recipes = Recipe.objects.with_perm(self.alice, 'cook')
+            self.assertEqual(
+                sorted(r.name for r in recipes),
+                [u'beef soup', u'vegetable soup']
+            )
+            self.assertEqual(len(recipes.query.alias_map), 1)
+            self.assertEqual(
+                list(Recipe.objects.with_perm(self.alice, 'eat')),
+                [self.vegetable_soup]
+            )
+            recipes = Recipe.objects.annotate_perms(
+                self.alice, ['eat', 'cook']
+            )
+            self.assertEqual(
+                dict((r.name, (r.can_eat, r.can_cook)) for r in recipes),
+                {
+                    u'vegetable soup': (True, True),
+                    u'beef soup': (False, True),
+                }
+            )
+
+    def test_rewrite_subqueries(self):
+        q = rewrite_subqueries(
+            Q(name='a') & Q(ingredients__is_meat=False) &
+            Q(ingredients__name='b') & ~Q(ingredients__owner=None),
+            Recipe
+        )
+        self.assertEqual(len(q.children), 3)
+        self.assertEqual(q.children[0], ('name', 'a'))
+        self.assertEqual(q.children[1][0], 'pk__in')
+        self.assertEqual(q.children[2].children[0][0], 'pk__in')
+        q = Q(owner__username='alice') | Q(recipe__name='b')
+        self.assertEqual(
+            rewrite_subqueries(q, Food).children[0],
+            ('owner__username', 'alice')
+        )
+
+    def test_queryset_annotation_multivalued(self):
+        recipes = Recipe.objects.annotate_perms(
+            self.alice, ['eat', 'cook']
+        ).order_by('name')
+        self.assertEqual(
+            [(r.name, r.can_eat, r.can_cook) for r in recipes],
+            [
+                (u'beef soup', False, True),
+                (u'vegetable soup', True, True),
+            ]
+        )
+
     def test_superuser_queryset_filtering(self):
         self.assertEqual(
             set(Food.objects.with_perm(self.superman, 'eat')),
             set(Food.objects.all())
         )
+
+
+class RoleCacheTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+
+    def test_roles_are_cached(self):
+        self.assertTrue(get_roles(self.alice) is get_roles(self.alice))
+
+    def test_roles_for_perm(self):
+        self.assertEqual(len(get_roles_for_perm(self.alice, 'eat', Food)), 1)
+        self.assertEqual(len(get_roles_for_perm(self.alice, 'eat')), 1)
+        self.assertEqual(get_roles_for_perm(self.alice, 'sleep', Food), [])
+        self.assertEqual(get_roles_for_perm(self.alice, 'eat', User), [])
+
+    def test_invalidate_roles(self):
+        roles = get_roles(self.alice)
+        invalidate_roles(self.alice)
+        self.assertFalse(get_roles(self.alice) is roles)
+        self.assertEqual(len(get_roles(self.alice)), len(roles))
+
+
+@override_settings(ROLE_CACHE='default')
+class SharedRoleCacheTestCase(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+
+    def fresh_alice(self):
+        # Same user, but the role provider would now give other roles.
+        alice = User.objects.get(pk=self.alice.pk)
+        alice.username = 'bob'
+        return alice
+
+    def test_roles_are_shared(self):
+        get_roles(self.alice)
+        roles = get_roles(self.fresh_alice())
+        self.assertEqual(len(roles), 1)
+        self.assertTrue(isinstance(roles[0], VegetarianRole))
+
+    def test_bump_roles_version(self):
+        get_roles(self.alice)
+        bump_roles_version(self.alice)
+        roles = get_roles(self.fresh_alice())
+        self.assertTrue(isinstance(roles[0], HippieRole))
+
+    def test_role_dependency(self):
+        get_roles(self.alice)
+        self.alice.username = 'bob'
+        self.alice.save()
+        roles = get_roles(User.objects.get(pk=self.alice.pk))
+        self.assertTrue(isinstance(roles[0], HippieRole))
+
+    def test_role_dependency_deferred(self):
+        get_roles(self.alice)
+        alice = User.objects.only('username').get(pk=self.alice.pk)
+        alice.username = 'bob'
+        alice.save()
+        roles = get_roles(User.objects.get(pk=self.alice.pk))
+        self.assertTrue(isinstance(roles[0], HippieRole))
+
+    def test_role_dependency_m2m(self):
+        get_roles(self.alice)
+        self.alice.groups.add(Group.objects.create(name=u'cooks'))
+        roles = get_roles(self.fresh_alice())
+        self.assertTrue(isinstance(roles[0], HippieRole))
+
+    def test_role_dependency_m2m_clear(self):
+        cooks = Group.objects.create(name=u'cooks')
+        self.alice.groups.add(cooks)
+        get_roles(self.alice)
+        cooks.user_set.clear()
+        roles = get_roles(self.fresh_alice())
+        self.assertTrue(isinstance(roles[0], HippieRole))
+
+    def test_unrelated_cache_key(self):
+        def get_cache_key(self, name):
+            return name
+        Recipe.get_cache_key = get_cache_key
+        try:
+            Recipe.objects.create(name=u'stew').delete()
+        finally:
+            del Recipe.get_cache_key
+
+    def test_role_dependency_delete(self):
+        get_roles(self.alice)
+        alice = self.fresh_alice()
+        self.alice.delete()
+        roles = get_roles(alice)
+        self.assertTrue(isinstance(roles[0], HippieRole))
+
+    def test_evicted_version(self):
+        get_roles(self.alice)
+        cache.delete('auf.django.permissions.roles_version:%s' % self.alice.pk)
+        roles = get_roles(self.fresh_alice())
+        self.assertTrue(isinstance(roles[0], HippieRole))
+
+
+def hippie_provider(user):
+    return [HippieRole()]
+
+
+def slow_provider(user):
+    time.sleep(0.5)
+    return [HippieRole()]
+
+
+def counting_provider(user):
+    counting_provider.calls += 1
+    return []
+counting_provider.calls = 0
+
+
+class MeatLoverRole(Role):
+
+    def get_filter_for_perm(self, perm, model):
+        if model is Food and perm == 'eat':
+            return Q(is_meat=True)
+        elif model is Recipe and perm == 'eat':
+            return Q(ingredients__is_meat=True)
+        return False
+
+    def get_cache_key(self):
+        return 'meat'
+
+
+def meat_lover_provider(user):
+    return [MeatLoverRole()]
+
+
+@override_settings(
+    ROLE_PROVIDERS=('tests.simpletests.tests.meat_lover_provider',),
+    PERMISSION_MATERIALIZED={
+        'simpletests.Food': ('eat',), 'simpletests.Recipe': ('eat',)
+    }
+)
+class MaterializedPermissionsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        permissions._role_providers = None
+        self.alice = User.objects.create(username='alice')
+        self.carrot = Food.objects.create(name=u'carrot', is_meat=False)
+        self.steak = Food.objects.create(name=u'steak', is_meat=True)
+
+    def tearDown(self):
+        permissions._role_providers = None
+
+    def test_rebuild(self):
+        self.assertEqual(
+            list(Food.objects.with_perm(self.alice, 'eat')), [self.steak]
+        )
+        call_command('rebuild_permissions', verbosity=0)
+        self.assertEqual(
+            list(MaterializedPermission.objects.values_list(
+                'object_id', flat=True
+            )),
+            [self.steak.pk]
+        )
+        foods = Food.objects.with_perm(self.alice, 'eat')
+        self.assertIn('materializedpermission', str(foods.query))
+        self.assertEqual(list(foods), [self.steak])
+        self.assertEqual(
+            [f.can_eat for f in Food.objects.annotate_perms(
+                self.alice, ['eat']
+            ).order_by('pk')],
+            [False, True]
+        )
+
+    def test_refresh(self):
+        call_command('rebuild_permissions', verbosity=0)
+        bacon = Food.objects.create(name=u'bacon', is_meat=True)
+        self.carrot.is_meat = True
+        self.carrot.save()
+        self.assertEqual(
+            list(Food.objects.with_perm(self.alice, 'eat')), [self.steak]
+        )
+        refresh_permissions(Food, [self.carrot.pk, bacon.pk], batch_size=1)
+        self.assertEqual(
+            set(Food.objects.with_perm(self.alice, 'eat')),
+            set([self.carrot, self.steak, bacon])
+        )
+        call_command('rebuild_permissions', refresh=True, verbosity=0)
+        self.assertEqual(MaterializedPermission.objects.count(), 3)
+
+    def test_refresh_partial_roles(self):
+        rebuild_permissions(Food)
+        refresh_permissions(Food, [self.steak.pk], roles={})
+        self.assertEqual(
+            list(Food.objects.with_perm(self.alice, 'eat')), [self.steak]
+        )
+
+    def test_multivalued_filter(self):
+        soup = Recipe.objects.create(name=u'beef soup')
+        soup.ingredients = [
+            self.steak, Food.objects.create(name=u'bacon', is_meat=True)
+        ]
+        Recipe.objects.create(name=u'water')
+        rebuild_permissions(Recipe, batch_size=1)
+        self.assertEqual(
+            list(MaterializedPermission.objects.filter(
+                content_type__model='recipe'
+            ).values_list('object_id', flat=True)),
+            [soup.pk]
+        )
+        refresh_permissions(Recipe, [soup.pk])
+        self.assertEqual(
+            list(Recipe.objects.with_perm(self.alice, 'eat')), [soup]
+        )
+
+    def test_bad_label(self):
+        self.assertRaises(
+            CommandError, call_command, 'rebuild_permissions', 'food',
+            verbosity=0
+        )
+
+
+def bulk_provider(user):
+    return bulk_provider.many([user])[0]
+
+
+def _bulk_provider_many(users):
+    bulk_provider.calls += 1
+    return [[MeatLoverRole()] for user in users]
+bulk_provider.many = _bulk_provider_many
+bulk_provider.calls = 0
+
+
+class TasterRole(Role):
+
+    def __init__(self, user):
+        self.user = user
+
+    def has_perm(self, perm, obj=None):
+        return self.user.username == 'user0'
+
+    def get_cache_key(self):
+        return 'taster'
+
+
+def taster_provider(user):
+    return [TasterRole(user)]
+
+
+class OwnerRole(Role):
+
+    def __init__(self, user):
+        self.user = user
+
+    def get_filter_for_perm(self, perm, model):
+        return Q(owner__username=self.user.username)
+
+
+def owner_provider(user):
+    return [OwnerRole(user)]
+
+
+@override_settings(
+    ROLE_PROVIDERS=('tests.simpletests.tests.bulk_provider',)
+)
+class UsersWithPermTestCase(TransactionTestCase):
+
+    def setUp(self):
+        permissions._role_providers = None
+        bulk_provider.calls = 0
+        for i in range(5):
+            User.objects.create(username='user%d' % i)
+        self.steak = Food.objects.create(name=u'steak', is_meat=True)
+        self.carrot = Food.objects.create(name=u'carrot', is_meat=False)
+
+    def tearDown(self):
+        permissions._role_providers = None
+
+    def test_bulk_providers(self):
+        self.assertEqual(len(users_with_perm(self.steak, 'eat')), 5)
+        self.assertEqual(bulk_provider.calls, 1)
+
+    @override_settings(
+        ROLE_PROVIDERS=('tests.simpletests.tests.taster_provider',)
+    )
+    def test_has_perm_is_not_shared(self):
+        permissions._role_providers = None
+        self.assertEqual(
+            [u.username for u in users_with_perm(self.carrot, 'eat')],
+            ['user0']
+        )
+
+    @override_settings(
+        ROLE_PROVIDERS=('tests.simpletests.tests.owner_provider',)
+    )
+    def test_uncached_roles_across_batches(self):
+        permissions._role_providers = None
+        self.carrot.owner = User.objects.get(username='user3')
+        self.carrot.save()
+        # Simulate the reuse of the ids of the roles freed with their user.
+        get_role_identity = permissions._get_role_identity
+        permissions._get_role_identity = lambda role: 42
+        batch_size = permissions.BULK_CHECK_BATCH_SIZE
+        permissions.BULK_CHECK_BATCH_SIZE = 1
+        try:
+            users = users_with_perm(self.carrot, 'eat')
+        finally:
+            permissions.BULK_CHECK_BATCH_SIZE = batch_size
+            permissions._get_role_identity = get_role_identity
+        self.assertEqual([u.username for u in users], ['user3'])
+
+    def test_roles_are_evaluated_once(self):
+        collector = InMemoryCollector()
+        add_collector(collector)
+        try:
+            self.assertEqual(users_with_perm(self.carrot, 'eat'), [])
+        finally:
+            remove_collector(collector)
+        stats = dict(
+            ((s['event'], s['name']), s) for s in collector.dump()
+        )
+        self.assertEqual(stats[('qeval', 'simpletests.Food')]['calls'], 1)
+
+
+class LazyRoleProvidersTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.bob = User.objects.create(username='bob')
+        permissions._role_providers = None
+        counting_provider.calls = 0
+
+    def tearDown(self):
+        permissions._role_providers = None
+
+    @override_settings(ROLE_PROVIDERS=(
+        'tests.simpletests.role_provider',
+        'tests.simpletests.tests.counting_provider',
+    ))
+    def test_first_grant_stops_resolution(self):
+        self.assertTrue(self.bob.has_perm('eat'))
+        self.assertEqual(counting_provider.calls, 0)
+        self.assertFalse(self.bob.has_perm('sleep'))
+        self.assertEqual(counting_provider.calls, 1)
+        self.assertEqual(len(get_roles(self.bob)), 1)
+        self.assertEqual(counting_provider.calls, 1)
+
+
+@override_settings(ROLE_PROVIDERS_THREADS=2)
+class ThreadedRoleProvidersTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        permissions._role_providers = None
+
+    def tearDown(self):
+        permissions._role_providers = None
+
+    @override_settings(ROLE_PROVIDERS=(
+        'tests.simpletests.tests.hippie_provider',
+        'tests.simpletests.role_provider',
+    ))
+    def test_roles_are_ordered(self):
+        roles = get_roles(self.alice)
+        self.assertTrue(isinstance(roles[0], HippieRole))
+        self.assertTrue(isinstance(roles[1], VegetarianRole))
+
+    @override_settings(ROLE_PROVIDERS=(
+        'tests.simpletests.tests.slow_provider',
+        'tests.simpletests.role_provider',
+    ), ROLE_PROVIDERS_TIMEOUT=0.1)
+    def test_timeout(self):
+        start = time.time()
+        roles = get_roles(self.alice)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(len(roles), 1)
+        self.assertTrue(isinstance(roles[0], VegetarianRole))
+
+
+class QevalTestCase(TransactionTestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.carrot = Food(name=u'Carrot', is_meat=False)
+
+    def test_lookups(self):
+        self.assertTrue(qeval(self.carrot, Q(name__istartswith='car')))
+        self.assertTrue(qeval(self.carrot, Q(name__iendswith='ROT')))
+        self.assertFalse(qeval(self.carrot, Q(name__endswith='ROT')))
+        self.assertTrue(qeval(self.carrot, Q(name__in=['Carrot', 'Leek'])))
+        self.assertTrue(qeval(self.carrot, Q(name__regex='^C.*t$')))
+        self.assertTrue(qeval(self.carrot, Q(owner__isnull=True)))
+        self.assertTrue(qeval(self.carrot, Q(owner=None)))
+        self.assertFalse(qeval(self.carrot, ~Q(is_meat=False)))
+
+    def test_compiled_predicates_are_cached(self):
+        predicate = compile_q(Q(is_meat=False) | Q(name='steak'))
+        self.assertTrue(
+            compile_q(Q(is_meat=False) | Q(name='steak')) is predicate
+        )
+        self.assertTrue(predicate(self.carrot))
+
+    def test_deferred_fields(self):
+        alice = User.objects.create(username='alice')
+        self.carrot.owner = alice
+        self.carrot.save()
+        q = Q(name='Carrot') & Q(is_meat=False) & Q(owner__username='alice')
+        carrot = Food.objects.only('id').get(pk=self.carrot.pk)
+        collector = InMemoryCollector()
+        add_collector(collector)
+        try:
+            with self.assertNumQueries(2):
+                self.assertTrue(qeval(carrot, q))
+        finally:
+            remove_collector(collector)
+        stats = dict(
+            ((s['event'], s['name']), s) for s in collector.dump()
+        )
+        self.assertEqual(
+            stats[('avoided_deferred_load', 'simpletests.Food')]['calls'], 2
+        )
+        carrot = Food.objects.only('id').get(pk=self.carrot.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(matches_filter(carrot, q))
+
+    def test_deferred_fields_other_database(self):
+        steak = Food.objects.create(name=u'steak', is_meat=True)
+        Food.objects.using('other').create(
+            pk=steak.pk, name=u'Carrot', is_meat=False
+        )
+        carrot = Food.objects.using('other').only('id').get(pk=steak.pk)
+        self.assertTrue(qeval(carrot, Q(name='Carrot') & Q(is_meat=False)))
+
+    @override_settings(PERMISSION_OBJECT_STRATEGY='database')
+    def test_database_strategy_other_database(self):
+        steak = Food.objects.create(name=u'steak', is_meat=True)
+        Food.objects.using('other').create(
+            pk=steak.pk, name=u'Carrot', is_meat=False
+        )
+        carrot = Food.objects.using('other').get(pk=steak.pk)
+        self.assertTrue(matches_filter(carrot, Q(is_meat=False)))
+
+    def test_deferred_related_fields(self):
+        alice = User.objects.create(username='alice', email='a@example.com')
+        self.carrot.owner = alice
+        self.carrot.save()
+        q = Q(owner__username='alice') & Q(owner__email='a@example.com')
+        carrot = Food.objects.select_related('owner') \
+                .only('name', 'owner__id').get(pk=self.carrot.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(qeval(carrot, q))
+
+    def test_deferred_analysis_is_cached(self):
+        alice = User.objects.create(username='alice')
+        self.carrot.owner = alice
+        self.carrot.save()
+        q = Q(name='Carrot') & Q(owner__username='alice')
+        self.assertTrue(qeval(Food.objects.get(pk=self.carrot.pk), q))
+
+        carrot = Food.objects.select_related('owner').get(pk=self.carrot.pk)
+
+        def get_field(*args, **kwargs):
+            raise AssertionError('get_field() called')
+        Food._meta.get_field = User._meta.get_field = get_field
+        try:
+            with self.assertNumQueries(0):
+                self.assertTrue(qeval(carrot, q))
+        finally:
+            del Food._meta.get_field, User._meta.get_field
+
+
+class TemplateTagsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        Food.objects.create(name=u'carrot', is_meat=False)
+        Food.objects.create(name=u'steak', is_meat=True)
+        self.foods = Food.objects.order_by('name')
+
+    def render(self, source):
+        template = Template('{% load permissions %}' + source)
+        return template.render(
+            Context({'user': self.alice, 'foods': self.foods})
+        )
+
+    def test_ifhasperm(self):
+        self.assertEqual(
+            self.render(
+                '{% for food in foods %}'
+                '{% ifhasperm "eat" food %}yes{% else %}no{% endifhasperm %}'
+                '{% endfor %}'
+            ),
+            'yesno'
+        )
+
+    def test_permsfor(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                self.render(
+                    '{% permsfor foods "eat" %}'
+                    '{% for food in foods %}'
+                    '{% if food.can_eat %}yes{% endif %}'
+                    '{% ifhasperm "eat" food %}yes{% endifhasperm %}'
+                    '{% withperms food as food_perms %}'
+                    '{% if food_perms.eat %}yes{% endif %}'
+                    '{% endwithperms %}'
+                    '{% endfor %}'
+                ),
+                'yesyesyes'
+            )
+
+    @override_settings(AUTHENTICATION_BACKENDS=(
+        'auf.django.permissions.AuthenticationBackend',
+        'tests.simpletests.tests.SteakBackend',
+    ))
+    def test_permsfor_other_backends(self):
+        self.assertEqual(
+            self.render(
+                '{% permsfor foods "eat" %}'
+                '{% for food in foods %}'
+                '{% if food.can_eat %}yes{% else %}no{% endif %}'
+                '{% ifhasperm "eat" food %}yes{% else %}no{% endifhasperm %}'
+                '{% endfor %}'
+            ),
+            'yesyesyesyes'
+        )
+
+
+    def test_permsfor_multivalued(self):
+        # Neither ingredient is both a vegetable and starts with a "c", but
+        # has_perm() finds one of each.
+        stew = Recipe.objects.create(name=u'stew')
+        stew.ingredients = [
+            Food.objects.create(name=u'chicken', is_meat=True),
+            Food.objects.create(name=u'leek', is_meat=False),
+        ]
+        template = Template(
+            '{% load permissions %}'
+            '{% permsfor recipes "cook" %}'
+            '{% for recipe in recipes %}'
+            '{% if recipe.can_cook %}yes{% else %}no{% endif %}'
+            '{% ifhasperm "cook" recipe %}yes{% else %}no{% endifhasperm %}'
+            '{% endfor %}'
+        )
+        context = Context({
+            'user': self.alice, 'recipes': Recipe.objects.all()
+        })
+        self.assertTrue(self.alice.has_perm('cook', stew))
+        self.assertEqual(template.render(context), 'yesyes')
+        with override_settings(PERMISSION_OBJECT_STRATEGY='database'):
+            invalidate_roles(self.alice)
+            self.assertFalse(self.alice.has_perm('cook', stew))
+            self.assertEqual(template.render(context), 'nono')
+
+
+class SteakBackend(object):
+
+    def authenticate(self, **credentials):
+        return None
+
+    def has_perm(self, user, perm, obj=None):
+        return perm == 'eat' and getattr(obj, 'name', None) == u'steak'
+
+
+class CeleryBackend(object):
+
+    def authenticate(self, **credentials):
+        return None
+
+    def has_perm(self, user, perm, obj=None):
+        return perm == 'delete' and getattr(obj, 'name', None) == u'celery'
+
+
+class CountingRole(Role):
+    calls = 0
+
+    def __init__(self, section, cached=True):
+        self.section = section
+        self.cached = cached
+
+    def get_filter_for_perm(self, perm, model):
+        CountingRole.calls += 1
+        return Q(name=self.section)
+
+    def get_cache_key(self):
+        return self.section if self.cached else None
+
+
+class FilterCacheTestCase(TransactionTestCase):
+
+    def setUp(self):
+        clear_filter_cache()
+        CountingRole.calls = 0
+
+    def test_filters_are_cached_by_key(self):
+        q = get_role_filter(CountingRole('sports'), 'edit', Food)
+        self.assertTrue(
+            get_role_filter(CountingRole('sports'), 'edit', Food) is q
+        )
+        self.assertEqual(CountingRole.calls, 1)
+        get_role_filter(CountingRole('travel'), 'edit', Food)
+        get_role_filter(CountingRole('sports'), 'view', Food)
+        self.assertEqual(CountingRole.calls, 3)
+
+    def test_roles_without_key_are_not_cached(self):
+        role = CountingRole('sports', cached=False)
+        get_role_filter(role, 'edit', Food)
+        get_role_filter(role, 'edit', Food)
+        self.assertEqual(CountingRole.calls, 2)
+
+
+class SimplifyQTestCase(TransactionTestCase):
+
+    def test_flatten(self):
+        q = simplify_q(Q(name='a') | (Q(is_meat=True) | Q(owner=None)))
+        self.assertEqual(q.connector, Q.OR)
+        self.assertEqual(
+            q.children,
+            [('name', 'a'), ('is_meat', True), ('owner', None)]
+        )
+
+    def test_duplicates(self):
+        q = simplify_q(Q(is_meat=False) & Q(is_meat=False))
+        self.assertEqual(q.children, [('is_meat', False)])
+
+    def test_merge_in_lookups(self):
+        q = simplify_q(
+            Q(name='a') | Q(name__in=['b', 'a']) | Q(name__exact='c') |
+            Q(is_meat=True)
+        )
+        self.assertEqual(
+            q.children,
+            [('name__in', ['a', 'b', 'c']), ('is_meat', True)]
+        )
+
+    def test_merge_only_fields(self):
+        q = simplify_q(
+            Q(owner__date_joined__hour=1) | Q(owner__date_joined__hour=2)
+        )
+        self.assertEqual(len(q.children), 2)
+        q = simplify_q(
+            Q(owner__date_joined__hour=1) | Q(owner__date_joined__hour=2),
+            Food
+        )
+        self.assertEqual(len(q.children), 2)
+        q = simplify_q(
+            Q(owner__username='a') | Q(owner__username__exact='b'), Food
+        )
+        self.assertEqual(
+            q.children, [('owner__username__in', ['a', 'b'])]
+        )
+
+    def test_absorption(self):
+        q = simplify_q(Q(name='a') | (Q(name='a') & Q(is_meat=True)))
+        self.assertEqual(q.children, [('name', 'a')])
+        q = simplify_q(Q(name='a') & (Q(name='a') | Q(is_meat=True)))
+        self.assertEqual(q.children, [('name', 'a')])
+
+    def test_negation(self):
+        q = simplify_q(~(Q(name='a') | Q(name='b')))
+        self.assertTrue(q.negated)
+        self.assertEqual(q.children, [('name__in', ['a', 'b'])])
+
+
+class InstrumentationTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.steak = Food.objects.create(name=u'steak', is_meat=True)
+        self.recipe = Recipe.objects.create(name=u'beef soup')
+        self.recipe.ingredients = [self.steak]
+        self.recipe = Recipe.objects.get(pk=self.recipe.pk)
+        clear_filter_cache()
+        self.collector = InMemoryCollector()
+        add_collector(self.collector)
+
+    def tearDown(self):
+        remove_collector(self.collector)
+
+    def test_collect(self):
+        self.assertFalse(self.alice.has_perm('eat', self.recipe))
+        Food.objects.with_perm(self.alice, 'eat')
+        stats = dict(
+            ((s['event'], s['name']), s) for s in self.collector.dump()
+        )
+        self.assertEqual(
+            stats[('provider', 'tests.simpletests.role_provider')]['calls'],
+            1
+        )
+        role = 'tests.simpletests.VegetarianRole'
+        self.assertEqual(stats[('has_perm', role)]['calls'], 1)
+        self.assertEqual(stats[('get_filter_for_perm', role)]['calls'], 2)
+        self.assertEqual(stats[('qeval', 'simpletests.Recipe')]['queries'], 1)
+        self.assertEqual(
+            stats[('queryset_with_perm', 'simpletests.Food')]['calls'], 1
+        )
+        self.collector.reset()
+        self.assertEqual(self.collector.dump(), [])
+
+    @override_settings(ROLE_PROVIDERS=(
+        'tests.simpletests.tests.partial_provider',
+        'tests.simpletests.tests.instance_provider',
+    ))
+    def test_provider_names(self):
+        permissions._role_providers = None
+        try:
+            self.alice.has_perm('eat')
+        finally:
+            permissions._role_providers = None
+        names = set(
+            s['name'] for s in self.collector.dump()
+            if s['event'] == 'provider'
+        )
+        self.assertEqual(
+            names,
+            set(['functools.partial', 'tests.simpletests.tests.Provider'])
+        )
+
+
+class Provider(object):
+
+    def __call__(self, user):
+        return []
+instance_provider = Provider()
+partial_provider = functools.partial(lambda user, roles: roles, roles=[])
+
+
+class GuardedModelAdminTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.carrot = Food.objects.create(
+            owner=self.alice, name=u'carrot', is_meat=False
+        )
+        self.celery = Food.objects.create(name=u'celery', is_meat=False)
+        self.steak = Food.objects.create(name=u'steak', is_meat=True)
+        self.request = RequestFactory().get('/')
+        self.request.user = self.alice
+        self.model_admin = GuardedModelAdmin(Food, AdminSite())
+
+    def test_queryset(self):
+        self.assertEqual(
+            set(self.model_admin.get_queryset(self.request)),
+            set([self.carrot, self.celery])
+        )
+
+    def test_changelist_row_perms(self):
+        with self.assertNumQueries(2):
+            cl = GuardedChangeList(
+                self.request, Food, ['name'], ['name'], [], None, [], False,
+                100, 200, [], self.model_admin
+            )
+        with self.assertNumQueries(1):
+            self.assertFalse(
+                self.model_admin.has_delete_permission(
+                    self.request, self.celery
+                )
+            )
+        self.assertEqual(
+            cl.row_perms['delete'],
+            {self.carrot.pk: True, self.celery.pk: False}
+        )
+        with self.assertNumQueries(0):
+            self.assertTrue(
+                self.model_admin.has_delete_permission(
+                    self.request, self.carrot
+                )
+            )
+            self.assertFalse(
+                self.model_admin.has_delete_permission(
+                    self.request, self.celery
+                )
+            )
+
+    @override_settings(AUTHENTICATION_BACKENDS=(
+        'auf.django.permissions.AuthenticationBackend',
+        'tests.simpletests.tests.CeleryBackend',
+    ))
+    def test_changelist_other_backends(self):
+        GuardedChangeList(
+            self.request, Food, ['name'], ['name'], [], None, [], False,
+            100, 200, [], self.model_admin
+        )
+        self.assertTrue(
+            self.model_admin.has_delete_permission(self.request, self.celery)
+        )
+        request = RequestFactory().get('/')
+        request.user = self.alice
+        self.assertTrue(
+            self.model_admin.has_delete_permission(request, self.celery)
+        )
+
+    def test_delete_action(self):
+        actions = self.model_admin.get_actions(self.request)
+        self.assertTrue(
+            actions['delete_selected'][0] is guarded_delete_selected
+        )
+
+
+@get_object(Food, 'eat', kwarg='food_id')
+def eat_view(request, food):
+    return HttpResponse(food.name)
+
+
+@get_object(Recipe, 'cook', kwarg='pk')
+def cook_view(request, recipe):
+    return HttpResponse(recipe.name)
+
+
+class GetObjectDecoratorTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carrot = Food.objects.create(name=u'carrot', is_meat=False)
+        self.steak = Food.objects.create(name=u'steak', is_meat=True)
+
+    def get(self, user, food_id):
+        request = RequestFactory().get('/')
+        request.user = user
+        return eat_view(request, food_id=food_id)
+
+    def test_allowed(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(self.alice, self.carrot.pk).content,
+                             'carrot')
+        self.assertEqual(self.get(self.bob, self.steak.pk).content, 'steak')
+
+    def test_forbidden(self):
+        self.assertRaises(
+            PermissionDenied, self.get, self.alice, self.steak.pk
+        )
+
+    def test_missing(self):
+        self.assertRaises(Http404, self.get, self.alice, 12345)
+
+    def test_inactive_superuser(self):
+        boss = User.objects.create(
+            username='boss', is_superuser=True, is_active=False
+        )
+        self.assertRaises(PermissionDenied, self.get, boss, self.steak.pk)
+        self.assertEqual(
+            user_has_perm_many(boss, 'eat', [self.carrot, self.steak]),
+            {self.carrot.pk: False, self.steak.pk: False}
+        )
+        boss.is_active = True
+        self.assertEqual(self.get(boss, self.steak.pk).content, 'steak')
+
+    def test_multivalued_filter(self):
+        soup = Recipe.objects.create(name=u'vegetable soup')
+        soup.ingredients = [
+            self.carrot, Food.objects.create(name=u'celery', is_meat=False)
+        ]
+        request = RequestFactory().get('/')
+        request.user = self.alice
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                cook_view(request, pk=soup.pk).content, 'vegetable soup'
+            )